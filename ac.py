@@ -1,11 +1,24 @@
 import sys
 import math
-from collections import defaultdict
+from array import array
+from collections import Counter, defaultdict
 from typing import *
 
+try:
+    import numpy as np
+except ImportError:  # Statistics fall back to plain Python, coding never needs it
+    np = None
+
 UPPER8 = ((1 << 8) - 1) << (64 - 8)
 TAIL8 = UPPER8 >> 8
 BITS64 = (1 << 64) - 1
+LOWER56 = BITS64 >> 8
+
+# For converting between bytes and their bits, most significant first, a byte string at a time
+BYTE_BITS = [
+    bytes((byte >> shift) & 1 for shift in range(7, -1, -1)) for byte in range(256)
+]
+BIT_DIGITS = bytes.maketrans(b"\x00\x01", b"01")
 
 
 def divide(a, b):
@@ -40,15 +53,87 @@ def nlog2(n):
     return 64 - math.log2(n)
 
 
+def counts_entropy(counts) -> float:
+    # In bits per symbol, for a histogram of how often each symbol occurs
+    if np is not None:
+        counts = np.asarray(counts, dtype=np.float64)
+        counts = counts[counts > 0]
+        if counts.size == 0:
+            return 0.0
+
+        p_values = counts / counts.sum()
+        return float(-(p_values * np.log2(p_values)).sum())
+
+    total = sum(counts)
+    if total == 0:
+        return 0.0
+
+    p_values = [count / total for count in counts if count > 0]
+
+    return sum(-p * math.log2(p) for p in p_values)
+
+
+def byte_histogram(data) -> List[int]:
+    if np is not None:
+        symbols = np.frombuffer(data, dtype=np.uint8)
+        return np.bincount(symbols, minlength=256).tolist()
+
+    return [bytes(data).count(byte) for byte in range(256)]
+
+
 def entropy(symbols):
+    if isinstance(symbols, (bytes, bytearray, memoryview)):
+        return counts_entropy(byte_histogram(symbols))
+
     histogram = {}
     for symbol in symbols:
         histogram[symbol] = histogram.get(symbol, 0) + 1
 
-    total = sum(histogram.values())
-    p_values = [count / total for count in histogram.values()]
+    return counts_entropy(list(histogram.values()))
 
-    return sum(-p * math.log2(p) for p in p_values)
+
+def pair_histogram(data) -> List[int]:
+    # How often each byte follows each other byte, indexed by 256 * previous + byte
+    if np is not None:
+        symbols = np.frombuffer(data, dtype=np.uint8).astype(np.int64)
+        pairs = symbols[:-1] * 256 + symbols[1:]
+        return np.bincount(pairs, minlength=256 * 256).tolist()
+
+    histogram = [0] * (256 * 256)
+    for (previous, byte), count in Counter(zip(data, data[1:])).items():
+        histogram[256 * previous + byte] = count
+
+    return histogram
+
+
+def counts_conditional_entropy(pairs) -> float:
+    # Order-1, for a pair histogram: bits per byte left once the byte before it is known
+    if np is not None:
+        pairs = np.asarray(pairs, dtype=np.float64).reshape(256, 256)
+        contexts = np.broadcast_to(pairs.sum(axis=1, keepdims=True), pairs.shape)
+        seen = pairs > 0
+        if not seen.any():
+            return 0.0
+
+        conditional = pairs[seen] / contexts[seen]
+        return float(-(pairs[seen] * np.log2(conditional)).sum() / pairs.sum())
+
+    total = sum(pairs)
+    if total == 0:
+        return 0.0
+
+    contexts = [
+        sum(pairs[256 * previous : 256 * previous + 256]) for previous in range(256)
+    ]
+    return sum(
+        -count / total * math.log2(count / contexts[pair >> 8])
+        for pair, count in enumerate(pairs)
+        if count > 0
+    )
+
+
+def conditional_entropy(data) -> float:
+    return counts_conditional_entropy(pair_histogram(data))
 
 
 class GlobalAdaptiveModel:
@@ -69,10 +154,129 @@ class GlobalAdaptiveModel:
     def range(self):
         return len(self.histogram)
 
+    def pvalues(self):
+        return [self.pvalue(i) for i in range(self.range())]
+
+    def interval(self, symbol):
+        # The counts below symbol and up to and including it, out of total
+        low = sum(self.histogram[:symbol])
+        return low, low + self.histogram[symbol]
+
+    def find(self, count):
+        # The symbol whose interval holds count
+        for symbol, frequency in enumerate(self.histogram):
+            if count < frequency:
+                return symbol
+
+            count -= frequency
+
+        return len(self.histogram) - 1
+
+
+class FenwickModel(GlobalAdaptiveModel):
+    # Keeps the counts in a Fenwick tree as well, so interval(), find() and update() all take O(log n) rather than O(n).
+    # Counts go up by INCREMENT to adapt faster, and are halved whenever the total passes LIMIT, which also keeps every
+    # symbol's share of a coding interval wide enough to code in.
+    INCREMENT = 32
+    LIMIT = 2**16
+
+    def __init__(self, n_symbols):
+        super().__init__(n_symbols)
+        self.tree = [0] * (n_symbols + 1)
+        self.top = 1 << (n_symbols.bit_length() - 1)  # Largest power of two in range
+        self.rebuild()
+
+    def rebuild(self):
+        tree = self.tree
+        tree[1:] = self.histogram
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+
+    def snapshot(self) -> "FenwickModel":
+        copied = object.__new__(FenwickModel)
+        copied.__dict__.update(self.__dict__)
+        copied.histogram = list(self.histogram)
+        copied.tree = list(self.tree)
+        return copied
+
+    def reset(self, template: "FenwickModel") -> None:
+        self.histogram[:] = template.histogram
+        self.tree[:] = template.tree
+        self.total = template.total
+
+    def restore(self, histogram: List[int]) -> None:
+        self.histogram = list(histogram)
+        self.total = sum(histogram)
+        self.rebuild()
+
+    def interval(self, symbol):
+        tree = self.tree
+        low = 0
+        i = symbol
+        while i > 0:
+            low += tree[i]
+            i &= i - 1
+
+        return low, low + self.histogram[symbol]
+
+    def find(self, count):
+        tree = self.tree
+        symbol = 0
+        step = self.top
+        while step:
+            i = symbol + step
+            if i < len(tree) and tree[i] <= count:
+                symbol = i
+                count -= tree[i]
+
+            step >>= 1
+
+        return min(symbol, len(self.histogram) - 1)
+
+    def update(self, symbol):
+        self.histogram[symbol] += self.INCREMENT
+        self.total += self.INCREMENT
+        tree = self.tree
+        i = symbol + 1
+        while i < len(tree):
+            tree[i] += self.INCREMENT
+            i += i & -i
+
+        if self.total > self.LIMIT:
+            self.histogram = [count - count // 2 for count in self.histogram]
+            self.total = sum(self.histogram)
+            self.rebuild()
+
+    def symbol_costs(self) -> List[float]:
+        # What coding each symbol would cost in bits at the current counts
+        return [math.log2(self.total / count) for count in self.histogram]
+
+
+class BinaryAdaptiveModel(GlobalAdaptiveModel):
+    # Binary models are asked for their p-values on every coded bit, so they're only recomputed when the counts change
+    def __init__(self):
+        super().__init__(2)
+        self.cached_pvalues = (divide(1, 2), divide(1, 2))
+
+    def pvalue(self, symbol):
+        return self.cached_pvalues[symbol]
+
+    def update(self, symbol):
+        self.histogram[symbol] += 1
+        self.total += 1
+        # Same as divide(), but neither count can reach the total so there's nothing to mask
+        zeros, ones = self.histogram
+        self.cached_pvalues = (zeros << 64) // self.total, (ones << 64) // self.total
+
+    def pvalues(self):
+        return self.cached_pvalues
+
 
 class MarkovNode:
     def __init__(self):
-        self.model = GlobalAdaptiveModel(2)
+        self.model = BinaryAdaptiveModel()
         self.children = [None, None]
         self.tag = None
         self.mispredictions = 0
@@ -88,8 +292,13 @@ class MarkovChainModel:
     def pvalue(self, symbol):
         return self.node.model.pvalue(symbol)
 
+    def pvalues(self):
+        return self.node.model.cached_pvalues
+
     def update(self, symbol):
-        predicted = 0 if self.node.model.pvalue(0) > self.node.model.pvalue(1) else 1
+        # Comparing counts gives the same answer as comparing p-values
+        histogram = self.node.model.histogram
+        predicted = 0 if histogram[0] > histogram[1] else 1
         if self.node.tag is not None:
             self.node.processed += 1
 
@@ -110,26 +319,24 @@ class MarkovChainModel:
 def compute_miss_recursively(
     node: MarkovNode,
     buckets: Dict[str, Tuple[int, int]],
-    visited: Set[MarkovNode] = set(),
+    visited: Set[MarkovNode],
 ) -> None:
+    # Marking nodes visited on the way down cuts the loops back to the root and the after-match context
     if node in visited:
         return
 
-    a, b = node.children
-    if a is not None and a.tag != "root":
-        compute_miss_recursively(a, buckets)
-    if b is not None and b.tag != "root":
-        compute_miss_recursively(b, buckets)
+    visited.add(node)
+    for child in node.children:
+        if child is not None:
+            compute_miss_recursively(child, buckets, visited)
 
     if node.tag is not None:
         buckets[node.tag] = node.mispredictions, node.processed
 
-    visited.add(node)
-
 
 def compute_miss_rate(node: MarkovNode) -> Dict[str, float]:
     buckets: Dict[str, Tuple[int, int]] = defaultdict(lambda: (0, 0))
-    compute_miss_recursively(node, buckets)
+    compute_miss_recursively(node, buckets, set())
     return {k: n / t for k, (n, t) in buckets.items() if t > 0}
 
 
@@ -150,27 +357,59 @@ def markov_join(node: MarkovNode, other: MarkovNode):
     return joined
 
 
-def build_markov_chain() -> MarkovNode:
+def build_markov_chain(
+    split_literals: bool = False, shared_tail: bool = True, byte_literals: bool = False
+) -> MarkovNode:
+    # The default layout is the one mini.asm decodes. split_literals gives literals straight after a back-reference
+    # contexts of their own, and without shared_tail the low 7 bits of extended codes get contexts of their own
+    # rather than sharing those of the short codes. byte_literals leaves literals out, going straight back to the
+    # root after a literal's control bit, for them to be coded a byte at a time by a model of their own. Every
+    # context gets a tag of its own, since miss rates and CostModel look them up by tag.
     root = MarkovNode()
     root.tag = "root"
-    short_length_model = build_markov_bitstring(root, 7)
+    after_match = root
+    if split_literals:
+        after_match = MarkovNode()
+        after_match.tag = "after_match"
+
+    short_length_model = build_markov_bitstring(after_match, 7)
     short_length_model.tag = "short_length"
-    ext_length_model = build_markov_bitstring(short_length_model, 8)
+    length_tail = short_length_model
+    if not shared_tail:
+        length_tail = build_markov_bitstring(after_match, 7)
+        length_tail.tag = "length_tail"
+
+    ext_length_model = build_markov_bitstring(length_tail, 8)
     ext_length_model.tag = "ext_length"
     length_model = markov_join(short_length_model, ext_length_model)
     length_model.tag = "length"
 
     short_offset_model = build_markov_bitstring(length_model, 7)
     short_offset_model.tag = "short_offset"
-    ext_offset_model = build_markov_bitstring(short_offset_model, 8)
+    offset_tail = short_offset_model
+    if not shared_tail:
+        offset_tail = build_markov_bitstring(length_model, 7)
+        offset_tail.tag = "offset_tail"
+
+    ext_offset_model = build_markov_bitstring(offset_tail, 8)
     ext_offset_model.tag = "ext_offset"
     offset_model = markov_join(short_offset_model, ext_offset_model)
     offset_model.tag = "offset"
 
+    root.children[1] = offset_model
+    after_match.children[1] = offset_model
+    if byte_literals:
+        root.children[0] = root
+        after_match.children[0] = root
+        return root
+
     literal_model = build_markov_bitstring(root, 8)
     literal_model.tag = "literal"
     root.children[0] = literal_model
-    root.children[1] = offset_model
+    if split_literals:
+        literal_after_match_model = build_markov_bitstring(root, 8)
+        literal_after_match_model.tag = "match_literal"
+        after_match.children[0] = literal_after_match_model
 
     return root
 
@@ -183,160 +422,488 @@ def build_markov_loop(n: int) -> MarkovNode:
     return root
 
 
+def postorder(node: MarkovNode, order: List[MarkovNode], visited: Set[MarkovNode]):
+    # The same order compute_miss_recursively() visits nodes in. Marking nodes visited on the way down cuts the loops
+    # back to the root, and to any other node on the way, such as the after-match context of a split_literals chain,
+    # which comes before the root.
+    if node in visited:
+        return
+
+    visited.add(node)
+    for child in node.children:
+        if child is not None:
+            postorder(child, order, visited)
+
+    order.append(node)
+
+
+class FlatMarkovModel:
+    # A Markov chain flattened into parallel arrays indexed by node ID, with each node's children and counts stored at
+    # 2 * ID + symbol. It codes exactly like a MarkovChainModel over the graph it was converted from, but copying one is
+    # just a matter of copying a few arrays. The ones touched for every bit are plain lists, since reading from an
+    # array.array boxes a fresh int each time and costs more than chasing MarkovNode pointers did.
+    def __init__(self, root: MarkovNode):
+        order: List[MarkovNode] = []
+        postorder(root, order, set())
+        ids = {node: i for i, node in enumerate(order)}
+
+        self.children = [0] * (2 * len(order))
+        self.counts = [0] * (2 * len(order))
+        self.cached_pvalues: List[Tuple[int, int]] = []
+        self.tags: List[Optional[str]] = []
+        self.mispredictions = array("q", [0] * len(order))
+        self.processed = array("q", [0] * len(order))
+        for i, node in enumerate(order):
+            for symbol in range(2):
+                self.children[2 * i + symbol] = ids[node.children[symbol]]
+                self.counts[2 * i + symbol] = node.model.histogram[symbol]
+
+            self.cached_pvalues.append((node.model.pvalue(0), node.model.pvalue(1)))
+            self.tags.append(node.tag)
+            self.mispredictions[i] = node.mispredictions
+            self.processed[i] = node.processed
+
+        self.node = ids[root]
+        self.named_parent = self.node
+        self.already_missed = False
+        # For chains built without literals, whatever codes them instead
+        self.literal_model: Optional[FenwickModel] = None
+
+    def snapshot(self) -> "FlatMarkovModel":
+        copied = object.__new__(FlatMarkovModel)
+        copied.__dict__.update(self.__dict__)
+        copied.counts = list(self.counts)
+        copied.cached_pvalues = list(self.cached_pvalues)
+        copied.mispredictions = array("q", self.mispredictions)
+        copied.processed = array("q", self.processed)
+        if self.literal_model is not None:
+            copied.literal_model = self.literal_model.snapshot()
+
+        return copied
+
+    def state(self) -> Tuple[int, List[int]]:
+        # Where the chain is and what it and any literal model have learned, which is all coding depends on
+        counts = list(self.counts)
+        if self.literal_model is not None:
+            counts += self.literal_model.histogram
+
+        return self.node, counts
+
+    def restore(self, node: int, counts: List[int]) -> None:
+        # Only meant for nodes with a tag, which is where the chain is between packets
+        if self.literal_model is not None:
+            self.literal_model.restore(counts[len(self.counts) :])
+            counts = counts[: len(self.counts)]
+
+        self.counts = list(counts)
+        self.cached_pvalues = [
+            ((zeros << 64) // (zeros + ones), (ones << 64) // (zeros + ones))
+            for zeros, ones in zip(counts[0::2], counts[1::2])
+        ]
+        self.node = self.named_parent = node
+        self.already_missed = False
+
+    def structure(self) -> Dict[str, Any]:
+        # The graph, but not what's been learned over it, for from_structure() to rebuild a fresh model from
+        return {"children": self.children, "tags": self.tags, "node": self.node}
+
+    @classmethod
+    def from_structure(cls, structure: Dict[str, Any]) -> "FlatMarkovModel":
+        # The same as flattening a freshly built chain, without building it
+        model = object.__new__(cls)
+        n_nodes = len(structure["tags"])
+        model.children = list(structure["children"])
+        model.counts = [1] * (2 * n_nodes)
+        model.cached_pvalues = [(divide(1, 2), divide(1, 2))] * n_nodes
+        model.tags = list(structure["tags"])
+        model.mispredictions = array("q", bytes(8 * n_nodes))
+        model.processed = array("q", bytes(8 * n_nodes))
+        model.node = model.named_parent = structure["node"]
+        model.already_missed = False
+        model.literal_model = None
+        return model
+
+    def reset(self, template: "FlatMarkovModel") -> None:
+        # Back to where template is, which has to share our graph, without allocating anything
+        self.counts[:] = template.counts
+        self.cached_pvalues[:] = template.cached_pvalues
+        self.mispredictions[:] = template.mispredictions
+        self.processed[:] = template.processed
+        self.node = template.node
+        self.named_parent = template.named_parent
+        self.already_missed = template.already_missed
+        if self.literal_model is not None:
+            self.literal_model.reset(template.literal_model)
+
+    def pvalue(self, symbol):
+        return self.cached_pvalues[self.node][symbol]
+
+    def pvalues(self):
+        return self.cached_pvalues[self.node]
+
+    def update(self, symbol):
+        node = self.node
+        base = node + node
+        counts = self.counts
+        zeros, ones = counts[base], counts[base + 1]
+        if (zeros > ones) != (symbol == 0) and not self.already_missed:
+            self.mispredictions[self.named_parent] += 1
+            self.already_missed = True
+
+        tags = self.tags
+        if tags[node] is not None:
+            self.processed[node] += 1
+
+        if symbol:
+            ones += 1
+            counts[base + 1] = ones
+        else:
+            zeros += 1
+            counts[base] = zeros
+
+        total = zeros + ones
+        self.cached_pvalues[node] = (zeros << 64) // total, (ones << 64) // total
+
+        node = self.children[base + symbol]
+        self.node = node
+        if tags[node] is not None:
+            self.named_parent = node
+            self.already_missed = False
+
+    def range(self):
+        return 2
+
+    def tag(self) -> Optional[str]:
+        return self.tags[self.node]
+
+    def bit_costs(self) -> List[float]:
+        # What coding each symbol at each node would cost in bits at the current probabilities
+        return [
+            nlog2(self.cached_pvalues[i // 2][i % 2]) for i in range(len(self.counts))
+        ]
+
+    def tag_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            tag: {
+                "processed": self.processed[i],
+                "mispredictions": self.mispredictions[i],
+                "zeros": self.counts[2 * i] - 1,
+                "ones": self.counts[2 * i + 1] - 1,
+            }
+            for i, tag in enumerate(self.tags)
+            if tag is not None
+        }
+
+    def miss_rates(self) -> Dict[str, float]:
+        return {
+            tag: self.mispredictions[i] / self.processed[i]
+            for i, tag in enumerate(self.tags)
+            if tag is not None and self.processed[i] > 0
+        }
+
+
 class Encoder:
-    def __init__(self) -> None:
+    def __init__(self, counting: bool = False) -> None:
         self.a = 0
         self.b = (1 << 64) - 1
-        self.encoded = b""
+        self.encoded = bytearray()
         self.pending = 0
         self.leader = 0
         self.input_count = 0
+        # Event counts, for profiling. Only kept when asked for: testing a local is cheaper than updating an attribute.
+        self.counting = counting
+        self.renormalisations = 0
+        self.straddles = 0
+        self.pending_flushes = 0
 
     def encode(self, model, data):
-        assert model.range() == 2
+        if model.range() != 2:
+            return self.encode_symbols(model, data)
+
         self.input_count += len(data)
 
-        for byte in data:
-            interval_width = subtract(self.b, self.a)
-            for i in range(model.range()):
-                p = model.pvalue(i)
-                subinterval_width = multiply(interval_width, p)
-                if subinterval_width == 0:
-                    print("Zero-width interval")
-
-                new_a = add(self.a, subinterval_width)
-                if byte == i:
-                    if new_a > self.b:
-                        print("Invariant broken")
-                        sys.exit(1)
-
-                    self.b = new_a
-                    break
-                else:
-                    self.a = new_a
-
-            while (self.a ^ self.b) & UPPER8 == 0:
+        # Binary models let us do without the generic per-symbol loop and the masking helpers: the subintervals never
+        # overflow the current interval, so only the shifts need masking
+        a, b = self.a, self.b
+        counting = self.counting
+        for bit in data:
+            p0, p1 = model.pvalues()
+            interval_width = b - a
+            split = a + ((interval_width * p0) >> 64)
+            if bit == 0:
+                b = split
+            else:
+                a = split
+                b = split + ((interval_width * p1) >> 64)
+
+            if a == b:
+                print("Zero-width interval")
+
+            while (a ^ b) & UPPER8 == 0:
                 # 8 bits have been locked in
+                if counting:
+                    self.renormalisations += 1
                 flush_pending = self.pending > 0
-                to_code = shr(self.a, 64 - 8)
-                self.encoded += to_code.to_bytes(1, "little")
-                self.a = shl(self.a, 8)
-                self.b = shl(self.b, 8)
-                self.b |= (1 << 8) - 1
+                to_code = a >> (64 - 8)
+                self.encoded.append(to_code)
+                a = (a << 8) & BITS64
+                b = ((b << 8) & BITS64) | ((1 << 8) - 1)
                 if flush_pending:
                     filler = 0xFF if to_code == self.leader else 0x00
-                    self.encoded += filler.to_bytes(1, "little") * self.pending
+                    self.encoded += bytes([filler]) * self.pending
                     self.pending = 0
+                    if counting:
+                        self.pending_flushes += 1
 
-            model.update(byte)
+            model.update(bit)
 
-            a_top = shr(self.a, 64 - 8)
-            b_top = shr(self.b, 64 - 8)
+            a_top = a >> (64 - 8)
+            b_top = b >> (64 - 8)
             if b_top - a_top == 1:
                 while True:
-                    a_tail = shr(self.a & TAIL8, 48)
-                    b_tail = shr(self.b & TAIL8, 48)
+                    a_tail = (a & TAIL8) >> 48
+                    b_tail = (b & TAIL8) >> 48
                     if a_tail == 0xFF and b_tail == 0x00:
                         self.leader = a_top
                         # How to understand this check:
                         # Think of the interval (0.799..., 0.8000...) in decimal.
                         # The interval may still shrink arbitrarily without ever actually locking in any digits
-                        self.a = shl(self.a, 8)
-                        self.b = shl(self.b, 8)
-                        self.b |= (1 << 8) - 1
+                        a = ((a << 8) & LOWER56) | (a_top << (64 - 8))
+                        b = ((b << 8) & LOWER56) | (b_top << (64 - 8)) | 0xFF
+                        self.pending += 1
+                        if counting:
+                            self.straddles += 1
+                    else:
+                        break
+
+        self.a, self.b = a, b
+
+    def encode_symbols(self, model, data):
+        # Each symbol gets a share of the interval in proportion to its count, with the same renormalisation as above
+        self.input_count += len(data)
+        a, b = self.a, self.b
+        counting = self.counting
+        for symbol in data:
+            low, high = model.interval(symbol)
+            total = model.total
+            interval_width = b - a
+            b = a + interval_width * high // total
+            a = a + interval_width * low // total
+            # Intervals stay at least 2**48 wide and totals under LIMIT + INCREMENT, so every symbol keeps a share
+            assert a < b
+
+            while (a ^ b) & UPPER8 == 0:
+                # 8 bits have been locked in
+                if counting:
+                    self.renormalisations += 1
+                flush_pending = self.pending > 0
+                to_code = a >> (64 - 8)
+                self.encoded.append(to_code)
+                a = (a << 8) & BITS64
+                b = ((b << 8) & BITS64) | ((1 << 8) - 1)
+                if flush_pending:
+                    filler = 0xFF if to_code == self.leader else 0x00
+                    self.encoded += bytes([filler]) * self.pending
+                    self.pending = 0
+                    if counting:
+                        self.pending_flushes += 1
+
+            model.update(symbol)
+
+            a_top = a >> (64 - 8)
+            b_top = b >> (64 - 8)
+            if b_top - a_top == 1:
+                while True:
+                    a_tail = (a & TAIL8) >> 48
+                    b_tail = (b & TAIL8) >> 48
+                    if a_tail == 0xFF and b_tail == 0x00:
+                        self.leader = a_top
+                        a = ((a << 8) & LOWER56) | (a_top << (64 - 8))
+                        b = ((b << 8) & LOWER56) | (b_top << (64 - 8)) | 0xFF
                         self.pending += 1
-                        self.a &= ~UPPER8
-                        self.b &= ~UPPER8
-                        self.a |= shl(a_top, 64 - 8)
-                        self.b |= shl(b_top, 64 - 8)
+                        if counting:
+                            self.straddles += 1
                     else:
                         break
 
+        self.a, self.b = a, b
+
+    def encode_bytes(self, model, data):
+        # Codes each byte as 8 bits through a binary model, without building a list of bits per byte
+        self.encode(model, b"".join(map(BYTE_BITS.__getitem__, data)))
+
+    def drain(self) -> bytes:
+        # Hands over the bytes locked in so far. Straddled bytes aren't in there until a carry decides them.
+        drained = bytes(self.encoded)
+        del self.encoded[:]
+        return drained
+
     def end_stream(self):
         flush_pending = self.pending > 0
         self.a = add(self.a, 1 << (64 - 8))  # The decoder semantics use open intervals
         to_code = shr(self.a, (64 - 8))
-        self.encoded += to_code.to_bytes(1, "little")
+        self.encoded.append(to_code)
         if flush_pending:
             filler = 0xFF if to_code == self.leader else 0x00
-            self.encoded += filler.to_bytes(1, "little") * self.pending
+            self.encoded += bytes([filler]) * self.pending
             self.pending = 0
 
-        return self.encoded
+        return bytes(self.encoded)
+
+
+DECODER_CHUNK = 2**16
 
 
 class Decoder:
-    def __init__(self, encoded):
-        self.bitgroups = [byte for byte in encoded]
+    # Accepts anything with the buffer protocol (bytes, memoryview, mmap, ...) without copying it, or a binary file
+    # object, which is read a chunk at a time. Anything past length bytes reads as zeroes, like the end of the stream.
+    def __init__(self, encoded, length: Optional[int] = None, counting: bool = False):
+        self.source = encoded if hasattr(encoded, "read") else None
+        self.bitgroups = memoryview(b"" if self.source else encoded)[:length]
+        self.base = 0  # Stream offset of bitgroups[0]
+        self.remaining = length
         self.a = 0
         self.b = (1 << 64) - 1
         self.window = 0
         self.i = 0
+        # Event counts, for profiling, as in Encoder
+        self.counting = counting
+        self.renormalisations = 0
+        self.straddles = 0
 
     def decode(self, model, expected_length):
         decoded = []
         while self.i < 8:
-            self.window = shl(self.window, 8) | (
-                self.bitgroups[self.i] if self.i < len(self.bitgroups) else 0
-            )
+            self.shift_window()
 
-            self.i += 1
+        if model.range() != 2:
+            return self.decode_symbols(model, expected_length, decoded)
 
+        # See Encoder.encode() for the binary shortcuts
+        a, b, window = self.a, self.b, self.window
+        counting = self.counting
         while len(decoded) < expected_length:
-            interval_width = subtract(self.b, self.a)
-            byte = None
-            for j in range(model.range()):
-                subinterval_width = multiply(interval_width, model.pvalue(j))
-                next_a = add(self.a, subinterval_width)
-                if next_a > self.window:
-                    self.b = next_a
-                    byte = j
-                    break
-
-                self.a = next_a
-
-            while (self.a ^ self.b) & UPPER8 == 0:
+            p0, p1 = model.pvalues()
+            interval_width = b - a
+            split = a + ((interval_width * p0) >> 64)
+            if split > window:
+                b = split
+                bit = 0
+            else:
+                a = split
+                b = split + ((interval_width * p1) >> 64)
+                bit = 1
+
+            while (a ^ b) & UPPER8 == 0:
                 # 8 bits have been locked in
-                self.a = shl(self.a, 8)
-                self.b = shl(self.b, 8)
-                self.b |= (1 << 8) - 1
-                self.shift_window()
+                if counting:
+                    self.renormalisations += 1
+                a = (a << 8) & BITS64
+                b = ((b << 8) & BITS64) | ((1 << 8) - 1)
+                window = ((window << 8) & BITS64) | self.next_bitgroup()
 
-            decoded += [byte]
-            model.update(byte)
+            decoded.append(bit)
+            model.update(bit)
 
-            a_top = shr(self.a, 64 - 8)
-            b_top = shr(self.b, 64 - 8)
+            a_top = a >> (64 - 8)
+            b_top = b >> (64 - 8)
             if b_top - a_top == 1:
                 while True:
-                    a_tail = shr(self.a & TAIL8, 48)
-                    b_tail = shr(self.b & TAIL8, 48)
+                    a_tail = (a & TAIL8) >> 48
+                    b_tail = (b & TAIL8) >> 48
                     if a_tail == 0xFF and b_tail == 0x00:
-                        # How to understand this check:
-                        # Think of the interval (0.799..., 0.8000...) in decimal.
-                        # The interval may still shrink arbitrarily without ever actually locking in any digits
-                        self.a = shl(self.a, 8)
-                        self.a &= ~UPPER8
-                        self.a |= shl(a_top, 64 - 8)
+                        a = ((a << 8) & LOWER56) | (a_top << (64 - 8))
+                        b = ((b << 8) & LOWER56) | (b_top << (64 - 8)) | 0xFF
+                        if counting:
+                            self.straddles += 1
+                        window_top = window >> (64 - 8)
+                        window = ((window << 8) & LOWER56) | self.next_bitgroup()
+                        window |= window_top << (64 - 8)
+                    else:
+                        break
+
+        self.a, self.b, self.window = a, b, window
+        return decoded
+
+    def state(self) -> Tuple[int, int, int, int]:
+        # Together with the state of the models, enough to carry on decoding from here given the same stream
+        return self.a, self.b, self.window, self.i
+
+    def restore(self, state: Tuple[int, int, int, int]) -> None:
+        assert self.source is None  # File objects are only ever read forwards
+        self.a, self.b, self.window, self.i = state
 
-                        self.b = shl(self.b, 8)
-                        self.b &= ~UPPER8
-                        self.b |= shl(b_top, 64 - 8)
+    def decode_bytes(self, model, count):
+        # The counterpart to Encoder.encode_bytes()
+        if count == 0:
+            return b""
 
-                        self.b |= (1 << 8) - 1
+        bits = self.decode(model, 8 * count)
+        return int(bytes(bits).translate(BIT_DIGITS), 2).to_bytes(count, "big")
 
-                        window_top = shr(self.window, 64 - 8)
-                        self.shift_window()
-                        self.window &= ~UPPER8
-                        self.window |= shl(window_top, 64 - 8)
+    def decode_symbols(self, model, expected_length, decoded):
+        # See Encoder.encode_symbols(). Of the counts that map to at most window, the largest tells us the symbol.
+        a, b, window = self.a, self.b, self.window
+        counting = self.counting
+        while len(decoded) < expected_length:
+            total = model.total
+            interval_width = b - a
+            symbol = model.find(((window - a + 1) * total - 1) // interval_width)
+            low, high = model.interval(symbol)
+            b = a + interval_width * high // total
+            a = a + interval_width * low // total
+
+            while (a ^ b) & UPPER8 == 0:
+                # 8 bits have been locked in
+                if counting:
+                    self.renormalisations += 1
+                a = (a << 8) & BITS64
+                b = ((b << 8) & BITS64) | ((1 << 8) - 1)
+                window = ((window << 8) & BITS64) | self.next_bitgroup()
+
+            decoded.append(symbol)
+            model.update(symbol)
+
+            a_top = a >> (64 - 8)
+            b_top = b >> (64 - 8)
+            if b_top - a_top == 1:
+                while True:
+                    a_tail = (a & TAIL8) >> 48
+                    b_tail = (b & TAIL8) >> 48
+                    if a_tail == 0xFF and b_tail == 0x00:
+                        a = ((a << 8) & LOWER56) | (a_top << (64 - 8))
+                        b = ((b << 8) & LOWER56) | (b_top << (64 - 8)) | 0xFF
+                        if counting:
+                            self.straddles += 1
+                        window_top = window >> (64 - 8)
+                        window = ((window << 8) & LOWER56) | self.next_bitgroup()
+                        window |= window_top << (64 - 8)
                     else:
                         break
 
+        self.a, self.b, self.window = a, b, window
         return decoded
 
     def shift_window(self):
-        self.window = shl(self.window, 8) | (
-            self.bitgroups[self.i] if self.i < len(self.bitgroups) else 0
-        )
+        self.window = shl(self.window, 8) | self.next_bitgroup()
+
+    def next_bitgroup(self):
+        # Reads that come back short are padded with zeroes, but the source is kept, so input that arrives later is
+        # still read from where it belongs in the stream
+        j = self.i - self.base
+        if j >= len(self.bitgroups) and self.source is not None:
+            chunk = DECODER_CHUNK
+            if self.remaining is not None:
+                chunk = min(chunk, self.remaining)
+
+            read = self.source.read(chunk) if chunk > 0 else b""
+            if read:
+                if self.remaining is not None:
+                    self.remaining -= len(read)
+
+                self.base += len(self.bitgroups)
+                self.bitgroups = memoryview(read)
+                j = self.i - self.base
 
         self.i += 1
+        return self.bitgroups[j] if j < len(self.bitgroups) else 0
@@ -0,0 +1,274 @@
+import os
+import sys
+import ac
+import json
+import time
+import random
+import platform
+import argparse
+import bitweaver
+from typing import *
+
+# Everything here is seeded, so a given size always benchmarks the same bytes
+
+X86_SNIPPETS = [
+    b"\x55\x48\x89\xe5",  # push rbp; mov rbp, rsp
+    b"\x48\x83\xec\x20",  # sub rsp, 32
+    b"\x48\x83\xc4\x20",  # add rsp, 32
+    b"\x5d\xc3",  # pop rbp; ret
+    b"\xc3",  # ret
+    b"\x48\x8b\x45\xf8",  # mov rax, [rbp - 8]
+    b"\x48\x89\x45\xf8",  # mov [rbp - 8], rax
+    b"\x48\x31\xc0",  # xor rax, rax
+    b"\x48\x85\xc0",  # test rax, rax
+    b"\x48\x8b\x07",  # mov rax, [rdi]
+    b"\x48\x89\x07",  # mov [rdi], rax
+    b"\x48\x83\xc7\x08",  # add rdi, 8
+    b"\x48\x83\xee\x08",  # sub rsi, 8
+    b"\x4c\x89\xe8",  # mov rax, r13
+    b"\x49\x89\xc5",  # mov r13, rax
+    b"\x90",  # nop
+]
+
+
+def random_corpus(rng: random.Random, size: int) -> bytes:
+    return bytes(rng.randrange(256) for _ in range(size))
+
+
+def repetitive_corpus(rng: random.Random, size: int) -> bytes:
+    phrases = [random_corpus(rng, rng.randrange(4, 32)) for _ in range(16)]
+    data = bytearray()
+    while len(data) < size:
+        phrase = bytearray(rng.choice(phrases))
+        if rng.random() < 0.1:
+            phrase[rng.randrange(len(phrase))] = rng.randrange(256)
+
+        data += phrase
+
+    return bytes(data[:size])
+
+
+def machine_code_corpus(rng: random.Random, size: int) -> bytes:
+    # Instruction-like byte sequences with call/jump displacements and the odd run of alignment padding
+    data = bytearray()
+    while len(data) < size:
+        choice = rng.random()
+        if choice < 0.15:
+            data.append(rng.choice(b"\xe8\xe9"))
+            data += rng.randrange(-4096, 4096).to_bytes(4, "little", signed=True)
+        elif choice < 0.2:
+            data += b"\x00" * rng.randrange(1, 16)
+        else:
+            data += rng.choice(X86_SNIPPETS)
+
+    return bytes(data[:size])
+
+
+def forth_corpus(rng: random.Random, size: int) -> bytes:
+    with open(os.path.join(os.path.dirname(__file__), "init.mini"), "rb") as rf:
+        source = rf.read()
+
+    data = bytearray()
+    while len(data) < size:
+        start = rng.randrange(len(source))
+        data += source[start : start + rng.randrange(256, 2048)]
+
+    return bytes(data[:size])
+
+
+CORPORA = {
+    "random": random_corpus,
+    "repetitive": repetitive_corpus,
+    "machine_code": machine_code_corpus,
+    "forth": forth_corpus,
+}
+
+
+def best_time(function: Callable[[], Any], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def megabytes_per_second(n_bytes: int, seconds: float) -> float:
+    return n_bytes / seconds / 1e6
+
+
+def bench_corpus(data: bytes, repeat: int) -> Dict[str, Dict[str, float]]:
+    results: Dict[str, Dict[str, float]] = {}
+    finders: List[bitweaver.MatchFinder] = []
+
+    def find_matches():
+        finder = bitweaver.MatchFinder(data)
+        for i in range(len(data)):
+            finder.find(i)
+
+        finders.append(finder)
+
+    seconds = best_time(find_matches, repeat)
+    results["match finding"] = {
+        "seconds": seconds,
+        "MB/s": megabytes_per_second(len(data), seconds),
+    }
+
+    seconds = best_time(lambda: bitweaver.parse(data, finders[-1]), repeat)
+    results["parse"] = {
+        "seconds": seconds,
+        "MB/s": megabytes_per_second(len(data), seconds),
+    }
+
+    encoded = b""
+
+    def encode():
+        nonlocal encoded
+        encoded = bitweaver.encode(data, len(data), verbose=False)
+
+    seconds = best_time(encode, repeat)
+    results["encode"] = {
+        "seconds": seconds,
+        "MB/s": megabytes_per_second(len(data), seconds),
+        "ratio": len(encoded) / len(data),
+    }
+
+    seconds = best_time(lambda: bitweaver.decode(encoded), repeat)
+    results["decode"] = {
+        "seconds": seconds,
+        "MB/s": megabytes_per_second(len(data), seconds),
+    }
+
+    return results
+
+
+def bench_coder(n_bits: int, repeat: int) -> Dict[str, Dict[str, float]]:
+    # Skewed bits through the real chain, so the models have something to learn
+    rng = random.Random(0)
+    bits = [1 if rng.random() < 0.2 else 0 for _ in range(n_bits)]
+    results: Dict[str, Dict[str, float]] = {}
+    template, _ = bitweaver.new_models()
+    model = template.snapshot()
+
+    def update_model():
+        model.reset(template)
+        for bit in bits:
+            model.update(bit)
+
+    seconds = best_time(update_model, repeat)
+    results["model update"] = {"seconds": seconds, "bits/s": n_bits / seconds}
+
+    encoded = b""
+
+    def encode_bits():
+        nonlocal encoded
+        encoder = ac.Encoder()
+        model.reset(template)
+        encoder.encode(model, bits)
+        encoded = encoder.end_stream()
+
+    seconds = best_time(encode_bits, repeat)
+    results["bit encoding"] = {"seconds": seconds, "bits/s": n_bits / seconds}
+
+    def decode_bits():
+        decoder = ac.Decoder(encoded)
+        model.reset(template)
+        decoded = decoder.decode(model, n_bits)
+        assert decoded == bits
+
+    seconds = best_time(decode_bits, repeat)
+    results["bit decoding"] = {"seconds": seconds, "bits/s": n_bits / seconds}
+
+    return results
+
+
+def run(size: int, n_bits: int, repeat: int) -> Dict[str, Any]:
+    results: Dict[str, Dict[str, float]] = {}
+    for name, generate in CORPORA.items():
+        data = generate(random.Random(name), size)
+        for stage, numbers in bench_corpus(data, repeat).items():
+            results[f"{name}/{stage}"] = numbers
+
+    for stage, numbers in bench_coder(n_bits, repeat).items():
+        results[f"coder/{stage}"] = numbers
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "size": size,
+        "bits": n_bits,
+        "results": results,
+    }
+
+
+def compare(
+    current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float
+) -> List[str]:
+    # Throughputs may drop by the tolerance before they count, but compression ratios are deterministic
+    regressions = []
+    for name, numbers in baseline["results"].items():
+        if name not in current["results"]:
+            continue
+
+        for metric, base in numbers.items():
+            value = current["results"][name].get(metric)
+            if value is None or metric == "seconds":
+                continue
+
+            if metric == "ratio":
+                regressed = value > base
+            else:
+                regressed = value < base * (1 - tolerance)
+
+            if regressed:
+                regressions.append(f"{name} {metric}: {value:.4g} (was {base:.4g})")
+
+    return regressions
+
+
+def report(current: Dict[str, Any]) -> None:
+    for name, numbers in current["results"].items():
+        fields = [
+            f"{value:.4g} {metric}"
+            for metric, value in numbers.items()
+            if metric != "seconds"
+        ]
+
+        print(f"{name}{' ' * (28 - len(name))}{', '.join(fields)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="bench.py")
+    parser.add_argument("--size", type=int, default=2**14, help="bytes per corpus")
+    parser.add_argument("--bits", type=int, default=2**17, help="bits to code")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs to take the best of"
+    )
+    parser.add_argument("--output", help="write the results here as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="fraction of baseline throughput that may be lost (default: 0.1)",
+    )
+
+    args = parser.parse_args()
+
+    current = run(args.size, args.bits, args.repeat)
+    report(current)
+    if args.output:
+        with open(args.output, "w") as wf:
+            json.dump(current, wf, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, "r") as rf:
+            baseline = json.load(rf)
+
+        regressions = compare(current, baseline, args.tolerance)
+        for regression in regressions:
+            print("Regression:", regression)
+
+        if regressions:
+            sys.exit(1)
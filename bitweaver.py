@@ -1,8 +1,201 @@
+import io
+import os
 import sys
 import ac
+import weave
+import glob
+import json
 import math
+import mmap
+import time
+import zlib
+import hashlib
+import functools
+import itertools
+import operator
+import shlex
+import bisect
+import heapq
+import socket
+import argparse
+import traceback
+import contextlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from typing import *
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class Profile:
+    # Wall and CPU time spent in each stage, named by its path through the enclosing stages, with time spent in nested
+    # stages also reported separately as "self" time. Also keeps event counters and per-tag model statistics.
+    def __init__(self) -> None:
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.counters: Dict[str, int] = {}
+        self.models: Dict[str, Dict[str, Any]] = {}
+        # Path, start wall, start CPU, child wall, child CPU
+        self.stack: List[List[Any]] = []
+
+    def enter(self, name: str) -> None:
+        path = f"{self.stack[-1][0]}/{name}" if self.stack else name
+        self.stack.append([path, time.perf_counter(), time.process_time(), 0.0, 0.0])
+
+    def leave(self) -> None:
+        path, wall, cpu, child_wall, child_cpu = self.stack.pop()
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        if self.stack:
+            self.stack[-1][3] += wall
+            self.stack[-1][4] += cpu
+
+        totals = self.stages.setdefault(
+            path,
+            {"calls": 0, "wall": 0.0, "cpu": 0.0, "self wall": 0.0, "self cpu": 0.0},
+        )
+
+        totals["calls"] += 1
+        totals["wall"] += wall
+        totals["cpu"] += cpu
+        totals["self wall"] += wall - child_wall
+        totals["self cpu"] += cpu - child_cpu
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.leave()
+
+    def timed(self, name: str, function: Callable) -> Callable:
+        def wrapper(*args):
+            self.enter(name)
+            try:
+                return function(*args)
+            finally:
+                self.leave()
+
+        return wrapper
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"stages": self.stages, "counters": self.counters, "models": self.models}
+
+
+# Only the process that activated a profile reports to it; worker processes go unprofiled
+active_profile: Optional[Profile] = None
+
+
+@contextlib.contextmanager
+def profiling(profile: Optional[Profile] = None) -> Iterator[Profile]:
+    global active_profile
+    previous = active_profile
+    active_profile = profile if profile is not None else Profile()
+    try:
+        yield active_profile
+    finally:
+        active_profile = previous
+
+
+def stage(name: str) -> ContextManager[None]:
+    if active_profile is None:
+        return contextlib.nullcontext()
+
+    return active_profile.stage(name)
+
+
+# Building the chains costs more than coding a small input does, so each process builds them once and codes with copies.
+# Their structure is also kept in the pack cache directory, if there is one, since loading it beats building them again.
+model_templates: Dict[Tuple[bool, bool, bool], ac.FlatMarkovModel] = {}
+dummy_template: Optional[ac.FlatMarkovModel] = None
+saved_structures: Optional[Dict[str, Any]] = None
+
+# Chain layouts are the (split_literals, shared_tail, byte_literals) arguments of build_markov_chain()
+DEFAULT_LAYOUT = (False, True, False)
+# Coding a literal whole takes one step through a multi-symbol model rather than eight through the chain
+BYTE_LITERALS_LAYOUT = (False, True, True)
+BYTE_SYMBOLS = 256
+TEMPLATE_FILE = "templates.json"
+
+
+def load_structures() -> Dict[str, Any]:
+    # Only trusted if written by the same version of the coder
+    try:
+        with open(os.path.join(CACHE_DIR, TEMPLATE_FILE), "r") as rf:
+            saved = json.load(rf)
+
+        if saved["version"] == CODER_VERSION:
+            return saved["structures"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    return {}
+
+
+def save_structures(structures: Dict[str, Any]) -> None:
+    if not os.path.isdir(CACHE_DIR):
+        return
+
+    temp_path = os.path.join(CACHE_DIR, f"{TEMPLATE_FILE}.{os.getpid()}.tmp")
+    try:
+        with open(temp_path, "w") as wf:
+            json.dump({"version": CODER_VERSION, "structures": structures}, wf)
+
+        os.replace(temp_path, os.path.join(CACHE_DIR, TEMPLATE_FILE))
+    except OSError:
+        pass
+
+
+def model_template(name: str, build: Callable[[], ac.MarkovNode]) -> ac.FlatMarkovModel:
+    global saved_structures
+    if saved_structures is None:
+        saved_structures = load_structures()
+
+    if name in saved_structures:
+        return ac.FlatMarkovModel.from_structure(saved_structures[name])
+
+    template = ac.FlatMarkovModel(build())
+    saved_structures[name] = template.structure()
+    save_structures(saved_structures)
+    return template
+
+
+def new_models(
+    layout: Tuple[bool, bool, bool] = DEFAULT_LAYOUT,
+) -> Tuple[ac.FlatMarkovModel, ac.FlatMarkovModel]:
+    global dummy_template
+    if layout not in model_templates:
+        split_literals, shared_tail, byte_literals = layout
+        template = model_template(
+            f"chain {split_literals:d}{shared_tail:d}{byte_literals:d}",
+            lambda: ac.build_markov_chain(*layout),
+        )
+        if byte_literals:
+            template.literal_model = ac.FenwickModel(BYTE_SYMBOLS)
+
+        model_templates[layout] = template
+
+    if dummy_template is None:
+        dummy_template = model_template("dummy", lambda: ac.build_markov_loop(1))
+
+    return model_templates[layout].snapshot(), dummy_template.snapshot()
+
+
+def reset_models(
+    chain_model: ac.FlatMarkovModel,
+    dummy_model: ac.FlatMarkovModel,
+    layout: Tuple[bool, bool, bool] = DEFAULT_LAYOUT,
+) -> None:
+    # Puts models from new_models() back the way they came, for coding another stream with
+    chain_model.reset(model_templates[layout])
+    dummy_model.reset(dummy_template)
+
 
 def encode_15bit(n: int) -> bytes:
     if n < 0x80:
@@ -12,112 +205,833 @@ def encode_15bit(n: int) -> bytes:
 
 
 def encode_bytes(encoder: ac.Encoder, bit_model, data: bytes):
-    for byte in data:
-        bitstring = [0] * 8
-        for i in range(8):
-            hibit = (byte & 0x80) >> 7
-            byte <<= 1
-            bitstring[i] = hibit
-
-        encoder.encode(bit_model, bitstring)
+    encoder.encode_bytes(bit_model, data)
 
 
 def decode_byte(decoder: ac.Decoder, bit_model) -> bytes:
-    return decode_bytes(decoder, bit_model, 1)
+    return decoder.decode_bytes(bit_model, 1)
 
 
 def decode_bytes(decoder: ac.Decoder, bit_model, count: int) -> bytes:
-    data = [0] * count
-    for n in range(count):
-        byte = 0
-        for i in range(8):
-            bit = decoder.decode(bit_model, 1)[0]
-            byte = (byte << 1) | bit
+    return decoder.decode_bytes(bit_model, count)
+
+
+def decode_literal(decoder: ac.Decoder, chain_model: ac.FlatMarkovModel) -> bytes:
+    if chain_model.literal_model is None:
+        return decoder.decode_bytes(chain_model, 1)
+
+    return bytes(decoder.decode(chain_model.literal_model, 1))
+
+
+class Memoization:
+    # The cheapest way found to code everything from each position on, as parallel arrays instead of an object per
+    # position: a literal (cbit 0, length 1) or a back-reference (cbit 1), and what it all costs in bits. The next
+    # packet starts length bytes on. Parses priced by size also note how far past each position the match search looked
+    # (span), which is what lets reparse() tell which positions an edit can affect.
+    def __init__(self, size: int):
+        self.cbit = array("B", bytes(size))
+        self.offset = array("H", bytes(2 * size))
+        self.length = array("H", bytes(2 * size))
+        self.cost = array("d", bytes(8 * size))
+        self.span = array("I", bytes(4 * size))
+
+    def __len__(self) -> int:
+        return len(self.cbit)
 
-        data[n] = byte
+    def set(self, i: int, cbit: int, offset: int, length: int, cost: float) -> None:
+        self.cbit[i] = cbit
+        self.offset[i] = offset
+        self.length[i] = length
+        self.cost[i] = cost
 
-    return bytes(data)
+    def code(self, data: bytes, i: int) -> bytes:
+        # What follows the control bit of the packet at i
+        if self.cbit[i] == 0:
+            return data[i : i + 1]
 
+        return encode_15bit(self.offset[i]) + encode_15bit(self.length[i])
 
-class Memo:
-    def __init__(self, cbit: int, data: bytes, cost: int, next: int):
+
+WINDOW_SIZE = 2**15 - 1
+MIN_MATCH = 3
+MAX_MATCH = 2**15 - 1  # encode_15bit can't represent anything longer
+SPAN = 64
+
+
+def match_length(data: bytes, a: int, b: int, start: int, limit: int) -> int:
+    length = start
+    while (
+        length + SPAN <= limit
+        and data[a + length : a + length + SPAN] == data[b + length : b + length + SPAN]
+    ):
+        length += SPAN
+
+    while length < limit and data[a + length] == data[b + length]:
+        length += 1
+
+    return length
+
+
+class MatchFinder:
+    # Hash chains over 3-byte prefixes. Runs of a repeated byte would make those chains degenerate (every position in a
+    # run of zeroes matches every other), so positions inside runs are instead served by chains of whole runs: one per
+    # byte value, and one per byte value and the byte that ends the run. Faster levels only follow the first max_chain
+    # links of a hash chain, which can miss the longest matches.
+    def __init__(
+        self,
+        data: bytes,
+        window_size: int = WINDOW_SIZE,
+        max_chain: Optional[int] = None,
+        min_match: int = MIN_MATCH,
+    ):
         self.data = data
-        self.cbit = cbit
-        self.cost = cost
-        self.next = next
-
-
-def unwrap(memo: Optional[Memo]) -> Memo:
-    assert memo is not None
-    return memo
-
-
-def encode(data: bytes, allocation_size: int) -> bytes:
-    encoder = ac.Encoder()
-    big_chain = ac.build_markov_chain()
-    chain_model = ac.MarkovChainModel(big_chain)
-    dummy_model = ac.MarkovChainModel(ac.build_markov_loop(1))
-
-    WINDOW_SIZE = 2**15 - 1
-    memoization: List[Optional[Memo]] = [None] * len(data)
-    for n in range(len(data)):
-        i = len(data) - n - 1
-        j = 3
-        lit_next_cost = unwrap(memoization[i + 1]).cost if i + 1 < len(data) else 0
-        best_option = Memo(0, data[i : i + 1], 1 + 8 + lit_next_cost, i + 1)
-        while True:
-            if i + j > len(data):
-                break
+        self.window_size = window_size
+        self.min_match = min_match  # Only what find() returns, the chains are always built over MIN_MATCH bytes
+        self.max_chain = len(data) + 1 if max_chain is None else max_chain
+        # Typed arrays rather than lists, at 4 bytes a position instead of a pointer to an int object
+        self.run = array("I", [1]) * len(data)
+        for i in range(len(data) - 2, -1, -1):
+            if data[i] == data[i + 1]:
+                self.run[i] = self.run[i + 1] + 1
+
+        self.chain = array("i", [-1]) * len(data)
+        self.run_start = array("i", [-1]) * len(data)
+        self.run_chain: Dict[int, int] = {}
+        heads: Dict[bytes, int] = {}
+        run_heads: Dict[int, int] = {}
+        ended_run_heads: Dict[bytes, int] = {}
+        i = 0
+        while i < len(data):
+            if self.run[i] >= MIN_MATCH:
+                end = i + self.run[i]
+                self.chain[i] = run_heads.get(data[i], -1)
+                run_heads[data[i]] = i
+                self.run_chain[i] = ended_run_heads.get(data[end - 1 : end + 1], -1)
+                ended_run_heads[data[end - 1 : end + 1]] = i
+                for j in range(i, end - MIN_MATCH + 1):
+                    self.run_start[j] = i
+
+                # The last couple of bytes of a run start ordinary prefixes
+                i = end - MIN_MATCH + 1
+            else:
+                key = data[i : i + MIN_MATCH]
+                if len(key) == MIN_MATCH:
+                    self.chain[i] = heads.get(key, -1)
+                    heads[key] = i
+
+                i += 1
+
+    def find(self, i: int) -> List[Tuple[int, int]]:
+        # Returns (offset, length) pairs with both strictly increasing: each offset is the closest match for every
+        # length above the previous pair's length, up to and including its own. This is exactly what a bytes.rfind()
+        # per length would have found.
+        if self.run_start[i] != -1:
+            candidates = self.find_in_run(i)
+            if self.min_match > MIN_MATCH:
+                candidates = [pair for pair in candidates if pair[1] >= self.min_match]
+
+            return candidates
+
+        data = self.data
+        limit = min(len(data) - i, MAX_MATCH)
+        window_base = max(0, i - self.window_size)
+        candidates: List[Tuple[int, int]] = []
+        best = self.min_match - 1
+        p = self.chain[i]
+        links = self.max_chain
+        while p >= window_base and best < limit and links > 0:
+            if (
+                data[p + best] == data[i + best]
+                and data[p : p + best] == data[i : i + best]
+            ):
+                best = match_length(data, p, i, best + 1, limit)
+                candidates.append((i - p, best))
+
+            p = self.chain[p]
+            links -= 1
 
-            window_base = max(0, i - WINDOW_SIZE)
-            window_data = data[window_base : i + j - 1]
-            m = window_data.rfind(data[i : i + j])
-            if m == -1:
+        return candidates
+
+    def find_in_run(self, i: int) -> List[Tuple[int, int]]:
+        data = self.data
+        run = self.run
+        limit = min(len(data) - i, MAX_MATCH)
+        window_base = max(0, i - self.window_size)
+        candidates: List[Tuple[int, int]] = []
+        best = MIN_MATCH - 1
+        r = run[i]
+        start = self.run_start[i]
+        if start < i:
+            # Everything behind us in our own run matches up to the end of the run
+            best = min(r, limit)
+            candidates.append((1, best))
+
+        # Walking backwards from the end of an earlier run, each step matches one more byte until we reach our own run
+        # length, where the match may carry on past the end of both runs
+        q = self.chain[start]
+        while best < r and q != -1:
+            end = q + run[q]
+            if end - MIN_MATCH < window_base:
+                return candidates
+
+            for length in range(best + 1, min(run[q], r - 1, limit) + 1):
+                p = end - length
+                if p < window_base:
+                    return candidates
+
+                candidates.append((i - p, length))
+                best = length
+
+            if run[q] >= r:
+                p = end - r
+                if p < window_base:
+                    return candidates
+
+                best = match_length(data, p, i, min(r, limit), limit)
+                candidates.append((i - p, best))
+
+            q = self.chain[q]
+
+        # Only runs at least as long as ours and ended by the same byte can do any better than that
+        q = self.run_chain[start]
+        while best < limit and q != -1:
+            p = q + run[q] - r
+            if p < window_base:
                 break
 
-            o, l = i - (window_base + m), j
-            offset_code = encode_15bit(o)
+            if p >= q and data[p + best] == data[i + best]:
+                length = match_length(data, p, i, r, limit)
+                if length > best:
+                    best = length
+                    candidates.append((i - p, best))
+
+            q = self.run_chain[q]
+
+        return candidates
+
+
+def find_function(finder: MatchFinder) -> Callable[[int], List[Tuple[int, int]]]:
+    profile = active_profile
+    if profile is None:
+        return finder.find
+
+    timed_find = profile.timed("match search", finder.find)
+
+    def find(i: int) -> List[Tuple[int, int]]:
+        candidates = timed_find(i)
+        profile.count("match queries")
+        profile.count("candidate matches", len(candidates))
+        return candidates
+
+    return find
+
+
+def parse(data: bytes, finder: MatchFinder, start: int = 0) -> Memoization:
+    # Only positions from start on get parsed, with anything before that only there to be matched against
+    with stage("parse"):
+        return parse_by_size(data, finder, start)
+
+
+COST_BLOCK = 64
+COST_LEVELS = (
+    3  # Blocks of COST_BLOCK ** 2 positions, so the longest matches span only a few
+)
+
+
+class Costs:
+    # The cost of coding everything from each position on, filled in from the end, along with the minimum of each block
+    # of COST_BLOCK positions once the whole block is in, the minimum of each block of COST_BLOCK of those, and so on. A
+    # back-reference's cheapest continuation is the minimum over its range of lengths, and ranges longer than a couple
+    # of blocks, which runs make plentiful, only scan their ends and the minima of the blocks in between.
+    def __init__(self, size: int):
+        self.minima = [
+            array("Q", bytes(8 * (size // COST_BLOCK**level + 1)))
+            for level in range(COST_LEVELS)
+        ]
+        self.values = self.minima[0]
+
+    def set(self, i: int, cost: int) -> None:
+        self.values[i] = cost
+        level = 0
+        while i % COST_BLOCK == 0 and level + 1 < COST_LEVELS:
+            below = self.minima[level]
+            i //= COST_BLOCK
+            level += 1
+            self.minima[level][i] = min(below[i * COST_BLOCK : (i + 1) * COST_BLOCK])
+
+    def fill(self, start: int, costs: Iterable[int]) -> None:
+        # Costs from start on, all at once
+        values = array("Q", costs)
+        self.values[start : start + len(values)] = values
+        for level in range(1, COST_LEVELS):
+            below = self.minima[level - 1]
+            start = -(-start // COST_BLOCK)
+            for i in range(start, len(self.minima[level])):
+                self.minima[level][i] = min(
+                    below[i * COST_BLOCK : (i + 1) * COST_BLOCK]
+                )
+
+    def cheapest(self, start: int, end: int, level: int = 0) -> Tuple[int, int]:
+        # The lowest cost from start to end inclusive, and the last position with it, at any level
+        values = self.minima[level]
+        first = -(
+            -start // COST_BLOCK
+        )  # Blocks first up to last lie wholly in the range
+        last = (end + 1) // COST_BLOCK
+        if last - first < 2 or level + 1 == COST_LEVELS:
+            span = values[start : end + 1]
+            cost = min(span)
+            return cost, end - span[::-1].index(cost)
+
+        cost, block = self.cheapest(first, last - 1, level + 1)
+        tail = values[last * COST_BLOCK : end + 1]
+        if tail and min(tail) <= cost:
+            cost = min(tail)
+            return cost, end - tail[::-1].index(cost)
+
+        head = values[start : first * COST_BLOCK]
+        if not head or cost <= min(head):
+            span = values[block * COST_BLOCK : (block + 1) * COST_BLOCK]
+            return cost, (block + 1) * COST_BLOCK - 1 - span[::-1].index(cost)
+
+        cost = min(head)
+        return cost, first * COST_BLOCK - 1 - head[::-1].index(cost)
+
+
+def parse_by_size(data: bytes, finder: MatchFinder, start: int = 0) -> Memoization:
+    # Prices everything at its uncoded size in bits
+    find = find_function(finder)
+    memoization = Memoization(len(data))
+    costs = Costs(len(data))
+    for i in range(len(data) - 1, start - 1, -1):
+        parse_position(memoization, costs, finder, find(i), i)
+
+    return memoization
+
+
+def parse_position(
+    memoization: Memoization,
+    costs: Costs,
+    finder: MatchFinder,
+    candidates: List[Tuple[int, int]],
+    i: int,
+) -> None:
+    cost = 1 + 8 + costs.values[i + 1]
+
+    # Ties between back-references go to the longest one
+    best_backref: Optional[Tuple[int, int, int]] = None
+    shortest = finder.min_match
+    for o, longest in candidates:
+        offset_code = encode_15bit(o)
+        # Within each range the code size is fixed, so only the cheapest continuation matters
+        for lo, hi in (
+            (shortest, min(longest, 0x7F)),
+            (max(shortest, 0x80), longest),
+        ):
+            if lo > hi:
+                continue
+
+            next_cost, l = costs.cheapest(i + lo, i + hi)
+            l -= i
             length_code = encode_15bit(l)
-            backref_cost = len(offset_code) + len(length_code)
-            next_cost = unwrap(memoization[i + l]).cost if i + l < len(data) else 0
-            backref_cost *= 8
-            backref_cost += next_cost
-            if backref_cost < best_option.cost:
-                best_option = Memo(
-                    1, offset_code + length_code, backref_cost + 1, i + l
+            backref_cost = 8 * (len(offset_code) + len(length_code)) + next_cost
+            if best_backref is None or backref_cost <= best_backref[0]:
+                best_backref = backref_cost, o, l
+
+        shortest = longest + 1
+
+    if best_backref is not None and best_backref[0] < cost:
+        backref_cost, o, l = best_backref
+        cost = backref_cost + 1
+        memoization.set(i, 1, o, l, cost)
+    else:
+        memoization.set(i, 0, 0, 1, cost)
+
+    costs.set(i, cost)
+    # The match search reads up to the byte that ended the longest match or the run at i, or at least the hash prefix
+    longest = candidates[-1][1] if candidates else 0
+    memoization.span[i] = max(longest, finder.run[i], finder.min_match)
+
+
+def common_prefix(a: bytes, b: bytes) -> int:
+    # Bisects on slice comparisons rather than comparing a byte at a time
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo
+
+
+def common_suffix(a: bytes, b: bytes, limit: int) -> int:
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid :] == b[len(b) - mid :]:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo
+
+
+def reparse(
+    data: bytes, finder: MatchFinder, old_data: bytes, old: Memoization, start: int = 0
+) -> Tuple[Memoization, int]:
+    # Parses data exactly as parse_by_size() would, given its parse of old_data, and returns how many positions it had
+    # to search and price. Past the edited bytes, positions whose whole window is unchanged search and price as they
+    # did before. Before them, positions whose search never read as far as the edit find the same matches, and once
+    # every cost those can see has changed by the same amount, they all choose as before at that much more cost.
+    n = len(data)
+    prefix = common_prefix(data, old_data)
+    suffix = common_suffix(data, old_data, min(n, len(old_data)) - prefix)
+    shift = n - len(old_data)
+    memoization = Memoization(n)
+    costs = Costs(n)
+
+    # Runs crossing into the unchanged bytes throw the match index out of step until they end
+    changed_end = n - suffix
+    synced = changed_end + (finder.run[changed_end] if changed_end < n else 0)
+    reused = min(n, synced + finder.window_size)
+    for copied, previous in (
+        (memoization.cbit, old.cbit),
+        (memoization.offset, old.offset),
+        (memoization.length, old.length),
+        (memoization.cost, old.cost),
+        (memoization.span, old.span),
+    ):
+        copied[reused:] = previous[reused - shift :]
+
+    costs.fill(reused, map(int, old.cost[reused - shift :]))
+
+    # How far the search read from each position, or any before it
+    reach = list(itertools.accumulate(map(operator.add, range(prefix), old.span), max))
+    find = find_function(finder)
+    difference: Optional[int] = None
+    # Costs from here down to the last position priced all changed by difference
+    unchanged_end = -1
+    for i in range(reused - 1, start - 1, -1):
+        if i < prefix and reach[i] < prefix and unchanged_end >= reach[i]:
+            for copied, previous in (
+                (memoization.cbit, old.cbit),
+                (memoization.offset, old.offset),
+                (memoization.length, old.length),
+                (memoization.span, old.span),
+            ):
+                copied[: i + 1] = previous[: i + 1]
+
+            memoization.cost[: i + 1] = array(
+                "d", (cost + difference for cost in old.cost[: i + 1])
+            )
+            return memoization, reused - 1 - i
+
+        parse_position(memoization, costs, finder, find(i), i)
+        if i < prefix and costs.values[i] - old.cost[i] != difference:
+            difference = costs.values[i] - int(old.cost[i])
+            unchanged_end = i
+
+    return memoization, reused - start
+
+
+def parse_greedy(
+    data: bytes, finder: MatchFinder, start: int = 0, lazy: bool = False
+) -> Memoization:
+    # Takes the longest match wherever there is one. A lazy parse first checks whether the next position has a longer
+    # one, and codes a literal to get to it if so. Only packet starts get filled in, with no costs.
+    with stage("parse"):
+        find = find_function(finder)
+        memoization = Memoization(len(data))
+        i = start
+        candidates = find(i) if i < len(data) else []
+        while i < len(data):
+            if candidates and lazy and i + 1 < len(data):
+                following = find(i + 1)
+                if following and following[-1][1] > candidates[-1][1]:
+                    memoization.set(i, 0, 0, 1, 0)
+                    i += 1
+                    candidates = following
+                    continue
+
+            if candidates:
+                o, l = candidates[-1]
+                memoization.set(i, 1, o, l, 0)
+            else:
+                l = 1
+                memoization.set(i, 0, 0, 1, 0)
+
+            i += l
+            candidates = find(i) if i < len(data) else []
+
+        return memoization
+
+
+# zlib-style compression levels: the parse each uses, and how many hash chain links the match finder follows per
+# position, if not all of them. Every level writes the same stream, only the parse differs, and extra passes only
+# apply to the optimal parses. Coding the parse takes most of the time below level 6, so chains shorter than 8 links
+# save next to nothing and only cost matches, and the limits never drop from one level to the next, or levels
+# would swap places on size. An optimal parse needs 64 links to beat the deepest lazy one.
+LEVELS: Dict[int, Tuple[str, Optional[int]]] = {
+    1: ("greedy", 8),
+    2: ("greedy", 16),
+    3: ("lazy", 16),
+    4: ("lazy", 32),
+    5: ("lazy", 64),
+    6: ("optimal", 64),
+    7: ("optimal", 128),
+    8: ("optimal", 256),
+    9: ("optimal", None),
+}
+DEFAULT_LEVEL = 9
+
+
+def level_finder(
+    data: bytes,
+    level: int,
+    window_size: int = WINDOW_SIZE,
+    min_match: int = MIN_MATCH,
+) -> MatchFinder:
+    with stage("match index"):
+        return MatchFinder(data, window_size, LEVELS[level][1], min_match)
+
+
+def parse_level(
+    data: bytes, finder: MatchFinder, level: int, start: int = 0
+) -> Memoization:
+    strategy, _ = LEVELS[level]
+    if strategy == "optimal":
+        return parse(data, finder, start)
+
+    return parse_greedy(data, finder, start, lazy=strategy == "lazy")
+
+
+def code_costs(
+    model: ac.FlatMarkovModel, bit_costs: List[float], node: int, n_bits: int
+) -> Tuple[List[float], int]:
+    # The cost of every n-bit code starting from a node, indexed by the code, and the node they all end up at
+    paths = [(0.0, node)]
+    for _ in range(n_bits):
+        paths = [
+            (cost + bit_costs[2 * at + bit], model.children[2 * at + bit])
+            for cost, at in paths
+            for bit in range(2)
+        ]
+
+    return [cost for cost, _ in paths], paths[0][1]
+
+
+class CostModel:
+    # What each literal, offset and length would cost to code, in bits, if the chain's probabilities were fixed at
+    # those of a model that has already coded a parse of the data
+    def __init__(self, model: ac.FlatMarkovModel):
+        bit_costs = model.bit_costs()
+        root = model.tags.index("root")  # The start of every packet, before any match
+        if model.literal_model is not None:
+            literals = model.literal_model.symbol_costs()
+        else:
+            literals, _ = code_costs(model, bit_costs, model.children[2 * root], 8)
+
+        self.literal = [bit_costs[2 * root] + cost for cost in literals]
+        self.backref = bit_costs[2 * root + 1]
+        self.offset, length_node = self.code_15bit_costs(
+            model, bit_costs, model.children[2 * root + 1]
+        )
+
+        self.length, _ = self.code_15bit_costs(model, bit_costs, length_node)
+
+    @staticmethod
+    def code_15bit_costs(
+        model: ac.FlatMarkovModel, bit_costs: List[float], node: int
+    ) -> Tuple[List[float], int]:
+        # The leading bit picks between the short code and the extended code, whose low 7 bits carry on into the short
+        # code's contexts with a shared tail, or into contexts of their own without
+        short_node, ext_node = model.children[2 * node], model.children[2 * node + 1]
+        short, end = code_costs(model, bit_costs, short_node, 7)
+        ext, tail_node = code_costs(model, bit_costs, ext_node, 8)
+        tail, _ = code_costs(model, bit_costs, tail_node, 7)
+        short_flag, ext_flag = bit_costs[2 * node], bit_costs[2 * node + 1]
+        costs = [short_flag + cost for cost in short]
+        costs += [
+            ext_flag + ext[n >> 7] + tail[n & 0x7F] for n in range(0x80, MAX_MATCH + 1)
+        ]
+
+        return costs, end
+
+
+def parse_modeled(
+    data: bytes, finder: MatchFinder, cost_model: CostModel, start: int = 0
+) -> Memoization:
+    with stage("modeled parse"):
+        return parse_by_model(data, finder, cost_model, start)
+
+
+def parse_by_model(
+    data: bytes, finder: MatchFinder, cost_model: CostModel, start: int = 0
+) -> Memoization:
+    find = find_function(finder)
+    memoization = Memoization(len(data))
+    costs = array("d", bytes(8 * (len(data) + 1)))
+    for i in range(len(data) - 1, start - 1, -1):
+        cost = cost_model.literal[data[i]] + costs[i + 1]
+        best = (0, 0, 1)
+        shortest = finder.min_match
+        for o, longest in find(i):
+            totals = list(
+                map(
+                    operator.add,
+                    cost_model.length[shortest : longest + 1],
+                    costs[i + shortest : i + longest + 1],
                 )
+            )
+
+            total = min(totals)
+            backref_cost = cost_model.backref + cost_model.offset[o] + total
+            if backref_cost < cost:
+                cost = backref_cost
+                best = (1, o, shortest + totals.index(total))
+
+            shortest = longest + 1
+
+        memoization.set(i, *best, cost)
+        costs[i] = cost
+
+    return memoization
+
+
+def code_parse(
+    data: bytes,
+    allocation_size: int,
+    memoization: Memoization,
+    layout: Tuple[bool, bool, bool] = DEFAULT_LAYOUT,
+    start: int = 0,
+) -> Tuple[bytes, ac.FlatMarkovModel, int]:
+    with stage("coding"):
+        encoder, chain_model = start_stream(allocation_size, len(data) - start, layout)
+        start_count = encoder.input_count
+        code_packets(encoder, chain_model, data, memoization, start)
+        uncoded_bits = encoder.input_count - start_count
+        return end_stream(encoder, chain_model), chain_model, uncoded_bits
 
-            j += 1
 
-        memoization[i] = best_option
+def start_stream(
+    allocation_size: int,
+    expected_bytes: int,
+    layout: Tuple[bool, bool, bool] = DEFAULT_LAYOUT,
+) -> Tuple[ac.Encoder, ac.FlatMarkovModel]:
+    # Codes the header, leaving the encoder and chain model ready for packets
+    profile = active_profile
+    encoder = ac.Encoder(counting=profile is not None)
+    chain_model, dummy_model = new_models(layout)
+    if profile is not None:
+        # Encoder.encode_bytes() looks encode() up on each call, so this gets timed as part of bit expansion
+        encoder.encode = profile.timed("arithmetic coding", encoder.encode)  # type: ignore
 
-    expected_bytes = len(data)
     encode_bytes(encoder, dummy_model, allocation_size.to_bytes(4, "big"))
-    assert dummy_model.node.tag == "root"
+    assert dummy_model.tag() == "root"
     encode_bytes(encoder, dummy_model, expected_bytes.to_bytes(4, "big"))
+    return encoder, chain_model
 
-    i = 0
-    start_count = encoder.input_count
+
+def code_packets(
+    encoder: ac.Encoder,
+    chain_model: ac.FlatMarkovModel,
+    data: bytes,
+    memoization: Memoization,
+    start: int = 0,
+) -> None:
+    expand = encode_bytes
+    if active_profile is not None:
+        expand = active_profile.timed("bit expansion", encode_bytes)
+
+    literal_model = chain_model.literal_model
+    i = start
     while i < len(data):
-        memo = memoization[i]
-        assert memo is not None
-        encoder.encode(chain_model, [memo.cbit])
-        encode_bytes(encoder, chain_model, memo.data)
-        i = memo.next
+        cbit = memoization.cbit[i]
+        encoder.encode(chain_model, [cbit])
+        if cbit == 0 and literal_model is not None:
+            encoder.encode(literal_model, data[i : i + 1])
+        else:
+            expand(encoder, chain_model, memoization.code(data, i))
 
-    end_count = encoder.input_count
+        i += memoization.length[i]
+
+
+def end_stream(encoder: ac.Encoder, chain_model: ac.FlatMarkovModel) -> bytes:
     coded = encoder.end_stream()
-    print(len(coded), "bytes compressed", sep="\t")
-    print(end_count - start_count, "bits uncoded", sep="\t")
-    print("Model miss rates:")
-    buckets = ac.compute_miss_rate(chain_model.node)
-    for bucket in buckets:
-        miss_rate = buckets[bucket]
-        print(f"\t{bucket}{' ' * (16 - len(bucket))}{100*miss_rate:.2f}%")
+    profile = active_profile
+    if profile is not None:
+        profile.count("renormalisations", encoder.renormalisations)
+        profile.count("straddles", encoder.straddles)
+        profile.count("pending byte flushes", encoder.pending_flushes)
+        profile.models = chain_model.tag_stats()
+
+    return coded
 
+
+def encode(
+    data: bytes,
+    allocation_size: int,
+    verbose: bool = True,
+    stats: Optional[Dict[str, Any]] = None,
+    passes: int = 1,
+    analysis: Optional[Dict[str, Any]] = None,
+    level: int = DEFAULT_LEVEL,
+    window_size: int = WINDOW_SIZE,
+    min_match: int = MIN_MATCH,
+    layout: Tuple[bool, bool, bool] = DEFAULT_LAYOUT,
+    incremental: Optional[Dict[str, Any]] = None,
+    dictionary: Optional[bytes] = None,
+) -> bytes:
+    # Each pass after the first re-parses with costs taken from how well the models coded the previous one, keeping
+    # whichever pass codes smallest. Streams coded with anything but the default layout start with a header naming it.
+    # Optimal parses can start from the parse of a previous input left in incremental by an earlier call, and leave
+    # their own there for the next. Any preset dictionary gets parsed ahead of the input, only to be matched against.
+    preset = preset_window(dictionary)
+    start = len(preset)
+    text = preset + bytes(data) if preset else data
+    finder = level_finder(text, level, window_size, min_match)
+    settings = [level, window_size, min_match, zlib.crc32(preset)]
+    optimal = LEVELS[level][0] == "optimal"
+    if optimal and incremental and incremental["settings"] == settings:
+        with stage("parse"):
+            memoization, reparsed = reparse(
+                text, finder, incremental["data"], incremental["memoization"], start
+            )
+    else:
+        memoization = parse_level(text, finder, level, start)
+        reparsed = len(data)
+
+    if incremental is not None:
+        incremental.clear()
+        if optimal:
+            incremental.update(
+                settings=settings, data=text, memoization=memoization, reparsed=reparsed
+            )
+
+    if active_profile is not None:
+        active_profile.count("positions parsed", reparsed)
+
+    best_memoization = memoization
+    coded, chain_model, uncoded_bits = code_parse(
+        text, allocation_size, memoization, layout, start
+    )
+    model = chain_model
+    if LEVELS[level][0] != "optimal":
+        passes = 1
+
+    for _ in range(passes - 1):
+        memoization = parse_modeled(text, finder, CostModel(model), start)
+        attempt = code_parse(text, allocation_size, memoization, layout, start)
+        if len(attempt[0]) < len(coded):
+            coded, chain_model, uncoded_bits = attempt
+            best_memoization = memoization
+
+        model = attempt[1]
+
+    if analysis is not None:
+        analysis.update(memoization_stats(best_memoization, start))
+
+    coded = add_dictionary(add_layout(coded, layout), dictionary)
+    report_encoding(coded, chain_model, uncoded_bits, verbose, stats)
+    return coded
+
+
+# Bounded-memory encoding parses and codes the input a segment at a time, so the match index and the parse only ever
+# cover one segment and the window of history before it. It still writes a single ordinary stream, but the parse can't
+# see past the end of a segment, which costs a little compression.
+# Peak usage of the match index and parse, with some margin
+PARSE_BYTES_PER_POSITION = 400
+
+
+def segment_size(memory_limit: int) -> int:
+    size = memory_limit // PARSE_BYTES_PER_POSITION - WINDOW_SIZE
+    if size < WINDOW_SIZE:
+        minimum = 2 * WINDOW_SIZE * PARSE_BYTES_PER_POSITION
+        raise ValueError(f"memory limits under {minimum} bytes are too low")
+
+    return size
+
+
+def encode_segmented(
+    data: bytes,
+    allocation_size: int,
+    memory_limit: int,
+    verbose: bool = True,
+    stats: Optional[Dict[str, Any]] = None,
+    analysis: Optional[Dict[str, Any]] = None,
+    level: int = DEFAULT_LEVEL,
+    layout: Tuple[bool, bool, bool] = DEFAULT_LAYOUT,
+    dictionary: Optional[bytes] = None,
+) -> bytes:
+    # Takes anything that slices to bytes-like objects, so memory-mapped input only gets read a segment at a time
+    size = segment_size(memory_limit)
+    preset = preset_window(dictionary)
+    encoder, chain_model = start_stream(allocation_size, len(data), layout)
+    start_count = encoder.input_count
+    segments_stats = parse_stats(0, [], [])
+    for start in range(0, len(data), size):
+        # Until the input fills a window, the history starts in the dictionary
+        before = bytes(data[max(0, start - WINDOW_SIZE) : start])
+        before = (
+            preset[len(preset) - min(len(preset), WINDOW_SIZE - len(before)) :] + before
+        )
+        history = len(before)
+        segment = before + bytes(data[start : start + size])
+        finder = level_finder(segment, level)
+        memoization = parse_level(segment, finder, level, history)
+        del finder  # Before the next one gets built
+        with stage("coding"):
+            code_packets(encoder, chain_model, segment, memoization, history)
+
+        if analysis is not None:
+            segment_stats = memoization_stats(memoization, history)
+            segments_stats = merge_parse_stats(segments_stats, segment_stats)
+
+        del memoization
+
+    uncoded_bits = encoder.input_count - start_count
+    coded = add_dictionary(
+        add_layout(end_stream(encoder, chain_model), layout), dictionary
+    )
+    if analysis is not None:
+        analysis.update(segments_stats)
+
+    report_encoding(coded, chain_model, uncoded_bits, verbose, stats)
     return coded
 
 
+def report_encoding(
+    coded: bytes,
+    chain_model: ac.FlatMarkovModel,
+    uncoded_bits: int,
+    verbose: bool,
+    stats: Optional[Dict[str, Any]],
+) -> None:
+    encode_stats = {
+        "bytes compressed": len(coded),
+        "bits uncoded": uncoded_bits,
+        "Model miss rates": chain_model.miss_rates(),
+    }
+
+    if stats is not None:
+        stats.update(encode_stats)
+
+    if verbose:
+        print_stats(encode_stats)
+
+
+def print_stats(stats: Dict[str, Any]) -> None:
+    for name, value in stats.items():
+        if isinstance(value, dict):
+            print(f"{name}:")
+            for bucket, rate in value.items():
+                print(f"\t{bucket}{' ' * (16 - len(bucket))}{100*rate:.2f}%")
+        else:
+            print(value, name, sep="\t")
+
+
 def decode_15bit(data: bytes) -> int:
     leader = data[0]
     if leader < 0x80:
@@ -126,157 +1040,2237 @@ def decode_15bit(data: bytes) -> int:
         return int.from_bytes(data, "big") & 0x7FFF
 
 
-def decode(encoded: bytes) -> bytes:
-    decoder = ac.Decoder(encoded)
-    big_chain = ac.build_markov_chain()
-    chain_model = ac.MarkovChainModel(big_chain)
-    dummy_model = ac.MarkovChainModel(ac.build_markov_loop(1))
+def decode_backref(decoder: ac.Decoder, chain_model) -> Tuple[int, int]:
+    offset_bytes = decode_byte(decoder, chain_model)
+    if offset_bytes[0] & 0x80 != 0:
+        offset_bytes += decode_byte(decoder, chain_model)
+
+    length_bytes = decode_byte(decoder, chain_model)
+    if length_bytes[0] & 0x80 != 0:
+        length_bytes += decode_byte(decoder, chain_model)
+
+    return decode_15bit(offset_bytes), decode_15bit(length_bytes)
+
+
+def copy_backref(decompressed: bytearray, n: int, offset: int, length: int) -> None:
+    # The assembly language version can just use byte-by-byte copies, but in python an overlapping reference is best
+    # done by repeating the pattern it overlaps
+    source = n - offset
+    if offset >= length:
+        decompressed[n : n + length] = decompressed[source : source + length]
+    else:
+        pattern = decompressed[source:n]
+        repeated = pattern * (length // offset + 1)
+        decompressed[n : n + length] = repeated[:length]
+
+
+def count_decoder_events(decoder: ac.Decoder) -> None:
+    if active_profile is not None:
+        active_profile.count("renormalisations", decoder.renormalisations)
+        active_profile.count("straddles", decoder.straddles)
+
+
+def decode(encoded: bytes, dictionary: Optional[bytes] = None) -> bytes:
+    encoded, checksum = split_trailer(encoded)
+    encoded, preset = split_dictionary(encoded, dictionary)
+    encoded, layout = split_layout(encoded)
+    decoder = ac.Decoder(encoded, counting=active_profile is not None)
+    chain_model, dummy_model = new_models(layout)
     _ = int.from_bytes(decode_bytes(decoder, dummy_model, 4), "big")
     expected_bytes = int.from_bytes(decode_bytes(decoder, dummy_model, 4), "big")
 
-    decompressed = b""
-    while len(decompressed) < expected_bytes:
+    decompressed = bytearray(preset) + bytearray(expected_bytes)
+    n = len(preset)
+    while n < len(decompressed):
         bit = decoder.decode(chain_model, 1)[0]
         if bit == 0:
-            literal = decode_byte(decoder, chain_model)
-            decompressed += literal
+            decompressed[n] = decode_literal(decoder, chain_model)[0]
+            n += 1
         else:
-            offset_bytes = decode_byte(decoder, chain_model)
-            if offset_bytes[0] & 0x80 != 0:
-                offset_bytes += decode_byte(decoder, chain_model)
+            offset, length = decode_backref(decoder, chain_model)
+            copy_backref(decompressed, n, offset, length)
+            n += length
 
-            length_bytes = decode_byte(decoder, chain_model)
-            if length_bytes[0] & 0x80 != 0:
-                length_bytes += decode_byte(decoder, chain_model)
+    count_decoder_events(decoder)
+    decompressed = bytes(decompressed[len(preset) :])
+    check_trailer(zlib.crc32(decompressed), checksum)
+    return decompressed
 
-            offset = decode_15bit(offset_bytes)
-            length = decode_15bit(length_bytes)
 
-            # This is necessary to do this even kind of efficiently in python, but the assembly language version can
-            # just use byte-by-byte copies.
-            if offset > length:
-                decompressed += decompressed[-offset : -(offset - length)]
-            else:
-                while length > 0:
-                    if offset <= length:
-                        decompressed += decompressed[-offset:]
-                    else:
-                        decompressed += decompressed[-offset : -(offset - length)]
+def iter_decode(
+    encoded,
+    chunk_size: int = 2**16,
+    length: Optional[int] = None,
+    dictionary: Optional[bytes] = None,
+) -> Iterator[bytes]:
+    # Like decode(), but yields the output in chunks of roughly chunk_size bytes as it goes, only holding on to as
+    # much history as back-references can reach. Only the first length bytes of the input are read, if given. File
+    # objects are read as they are, so their trailer is left for the caller to find and check, which needs a seek.
+    checksum = None
+    if hasattr(encoded, "read"):
+        start = encoded.tell()
+        header = encoded.read(DICTIONARY_HEADER_SIZE)
+        _, preset = split_dictionary(header, dictionary)
+        if stream_dictionary(header) is None:
+            encoded.seek(start)
+        else:
+            length = None if length is None else length - DICTIONARY_HEADER_SIZE
 
-                    length -= offset
+        start = encoded.tell()
+        header = encoded.read(LAYOUT_HEADER_SIZE)
+        if is_tuned(header) and len(header) == LAYOUT_HEADER_SIZE:
+            layout = split_layout(header)[1]
+            length = None if length is None else length - LAYOUT_HEADER_SIZE
+        else:
+            encoded.seek(start)
+            layout = DEFAULT_LAYOUT
+    else:
+        encoded, checksum = split_trailer(encoded[:length])
+        encoded, preset = split_dictionary(encoded, dictionary)
+        encoded, layout = split_layout(encoded)
 
-    return decompressed
+    decoder = ac.Decoder(encoded, length, counting=active_profile is not None)
+    chain_model, dummy_model = new_models(layout)
+    _ = int.from_bytes(decode_bytes(decoder, dummy_model, 4), "big")
+    expected_bytes = int.from_bytes(decode_bytes(decoder, dummy_model, 4), "big")
 
+    history = bytearray(preset)
+    unyielded = len(history)  # Where the bytes not yet handed out start in history
+    produced = 0
+    decoded_checksum = 0
+    while produced < expected_bytes:
+        bit = decoder.decode(chain_model, 1)[0]
+        if bit == 0:
+            history += decode_literal(decoder, chain_model)
+            produced += 1
+        else:
+            offset, length = decode_backref(decoder, chain_model)
+            copy_backref(history, len(history), offset, length)
+            produced += length
 
-def get_size(data: bytes) -> Tuple[bytes, int]:
-    bss_size = 0
-    bss_size = int.from_bytes(data[0:8], "little")
-    if bss_size > 2**32:  # We're probably dealing with a non-image
-        bss_size = 0
-    else:
-        data = data[8:]
+        if len(history) - unyielded >= chunk_size and produced < expected_bytes:
+            chunk = bytes(history[unyielded:])
+            decoded_checksum = zlib.crc32(chunk, decoded_checksum)
+            yield chunk
+            del history[: max(0, len(history) - WINDOW_SIZE)]
+            unyielded = len(history)
 
-    print(bss_size, "extra bytes of BSS", sep="\t")
+    count_decoder_events(decoder)
+    # The last chunk only goes out once the whole output has been checked
+    chunk = bytes(history[unyielded:])
+    check_trailer(zlib.crc32(chunk, decoded_checksum), checksum)
+    if chunk:
+        yield chunk
 
-    return data, len(data) + bss_size
 
+# Streaming counterparts to encode() and decode(), along the lines of zlib.compressobj() and zlib.decompressobj(), that
+# never print. The compressor parses a lookahead's worth of input at a time, behind a window of history, and hands over
+# coded bytes as soon as the encoder locks them in. The stream header holds the decoded size, so unless it's given up
+# front the compressor has to hold on to all of its input until flush(). Like bounded-memory encoding, parsing a segment
+# at a time costs a little compression, unless the lookahead covers the whole input.
+COMPRESS_LOOKAHEAD = 2**16
+# Bytes of input the decompressor keeps in hand before decoding a packet, more than even the longest packet at the most
+# lopsided probabilities can use
+DECOMPRESS_MARGIN = 512
 
-def info(data: bytes) -> None:
-    decoder = ac.Decoder(data)
-    big_chain = ac.build_markov_chain()
-    chain_model = ac.MarkovChainModel(big_chain)
-    dummy_model = ac.MarkovChainModel(ac.build_markov_loop(1))
 
-    allocation_size = int.from_bytes(decode_bytes(decoder, dummy_model, 4), "big")
-    expected_bytes = int.from_bytes(decode_bytes(decoder, dummy_model, 4), "big")
+class Compressor:
+    def __init__(
+        self,
+        size: Optional[int] = None,
+        allocation_size: Optional[int] = None,
+        level: int = DEFAULT_LEVEL,
+        lookahead: int = COMPRESS_LOOKAHEAD,
+        layout: Tuple[bool, bool, bool] = DEFAULT_LAYOUT,
+        dictionary: Optional[bytes] = None,
+    ):
+        self.size = size
+        self.allocation_size = allocation_size
+        self.level = level
+        self.lookahead = lookahead
+        self.layout = layout
+        # Goes out ahead of the first coded byte
+        self.header = add_dictionary(add_layout(b"", layout), dictionary)
+        # Uncoded input, after the history it can refer back to, which starts out as the dictionary
+        self.pending = bytearray(preset_window(dictionary))
+        self.history = len(self.pending)
+        self.received = 0
+        self.encoder: Optional[ac.Encoder] = None
+        self.chain_model: Optional[ac.FlatMarkovModel] = None
 
-    print(allocation_size, "bytes allocated", sep="\t")
-    print(expected_bytes, "bytes expected", sep="\t")
+    def compress(self, data: bytes) -> bytes:
+        self.received += len(data)
+        if self.size is not None and self.received > self.size:
+            raise ValueError(f"more than the {self.size} bytes expected")
 
-    bytes_counted = 0
-    control_bit_count = 0
-    literal_byte_count = 0
-    offset_byte_count = 0
-    length_byte_count = 0
-    pair_count = 0
-    extended_offset_count = 0
-    extended_length_count = 0
-    while bytes_counted < expected_bytes:
-        bit = decoder.decode(chain_model, 1)[0]
-        control_bit_count += 1
-        if bit == 0:
-            decode_byte(decoder, chain_model)
-            literal_byte_count += 1
-            bytes_counted += 1
-        else:
-            pair_count += 1
-            b = decode_byte(decoder, chain_model)
-            offset_byte_count += 1
-            if b[0] & 0x80 != 0:
-                decode_byte(decoder, chain_model)
-                offset_byte_count += 1
-                extended_offset_count += 1
-
-            b = decode_byte(decoder, chain_model)
-            length_byte_count += 1
-            if b[0] & 0x80 != 0:
-                b += decode_byte(decoder, chain_model)
-                length_byte_count += 1
-                extended_length_count += 1
-
-            bytes_counted += decode_15bit(b)
-
-    print(control_bit_count, "control bits", sep="\t")
-    print(literal_byte_count, "literal bytes", sep="\t")
-    print(offset_byte_count, "offset bytes", sep="\t")
-    print(extended_offset_count, "extended offsets", sep="\t")
-    print(length_byte_count, "length bytes", sep="\t")
-    print(extended_length_count, "extended lengths", sep="\t")
-    print(pair_count, "offset-length pairs", sep="\t")
+        self.pending += data
+        if self.size is None:
+            return b""
 
-    uncoded_length = (
-        math.ceil(control_bit_count / 8)
-        + literal_byte_count
-        + offset_byte_count
-        + length_byte_count
-    )
+        while len(self.pending) - self.history >= self.lookahead:
+            self.code_segment(self.lookahead)
 
-    print(uncoded_length, "bytes uncoded", sep="\t")
-    print(f"{100 * len(data) / uncoded_length :.2f}%\tcoding ratio")
-    print(f"{100 * uncoded_length / expected_bytes :.2f}%\tuncoded compression ratio")
-    print(f"{100 * len(data) / expected_bytes :.2f}%\ttotal compression ratio")
+        return self.output(self.encoder.drain()) if self.encoder is not None else b""
 
+    def flush(self) -> bytes:
+        if self.size is None:
+            self.size = self.received
+        elif self.received != self.size:
+            raise ValueError(f"{self.received} bytes given, {self.size} expected")
 
-if __name__ == "__main__":
-    if sys.argv[1] not in ("pack", "unpack", "info"):
-        print("Usage: bitweaver.py <pack|unpack|info> [...]")
-        sys.exit(1)
+        self.code_segment(len(self.pending) - self.history)
+        return self.output(self.encoder.end_stream())
 
-    command = sys.argv[1]
-    if command in ("pack", "unpack") and len(sys.argv) != 4:
-        print("Usage: bitweaver.py <pack|unpack> <input> <output>")
-        sys.exit(1)
-    elif command == "info" and len(sys.argv) != 3:
-        print("Usage: bitweaver.py info <input>")
-        sys.exit(1)
+    def output(self, coded: bytes) -> bytes:
+        if coded:
+            coded, self.header = self.header + coded, b""
 
-    with open(sys.argv[2], "rb") as rf:
-        data = rf.read()
+        return coded
 
-    if command == "pack":
-        data, full_size = get_size(data)
-        encoded = encode(data, full_size)
-        print(f"{100 * len(encoded) / len(data) :.2f}%\tcompression ratio")
-        decoded = decode(encoded)
-        if decoded != data:
-            print("Stream corruption detected!")
-            sys.exit(1)
+    def code_segment(self, count: int) -> None:
+        if self.encoder is None:
+            allocation_size = self.allocation_size
+            if allocation_size is None:
+                allocation_size = self.size
 
-        with open(sys.argv[3], "wb") as wf:
-            wf.write(encoded)
-    elif command == "unpack":
-        decoded = decode(data)
-        with open(sys.argv[3], "wb") as wf:
-            wf.write(decoded)
-    elif command == "info":
-        info(data)
+            self.encoder, self.chain_model = start_stream(
+                allocation_size, self.size, self.layout
+            )
+
+        segment = bytes(self.pending[: self.history + count])
+        finder = level_finder(segment, self.level)
+        memoization = parse_level(segment, finder, self.level, self.history)
+        del finder
+        with stage("coding"):
+            code_packets(
+                self.encoder, self.chain_model, segment, memoization, self.history
+            )
+
+        self.history = min(len(segment), WINDOW_SIZE)
+        del self.pending[: len(segment) - self.history]
+
+
+class InputQueue:
+    # What a Decoder reads from while a stream is still arriving
+    def __init__(self):
+        self.queued = bytearray()
+        self.taken = 0  # Bytes read from the queue so far
+
+    def read(self, size: int) -> bytes:
+        taken = bytes(self.queued[:size])
+        del self.queued[:size]
+        self.taken += len(taken)
+        return taken
+
+
+class Decompressor:
+    # Reads single streams, with any layout header and checksum trailer. Input past what the decoder has taken in is
+    # handed back in unconsumed_tail whenever max_length stops decoding early, like zlib does. The last TRAILER_SIZE
+    # bytes given are held back from the decoder until flush(), when they either turn out to be a trailer, and the
+    # output gets checked against it, or go to the decoder after all.
+    def __init__(self, dictionary: Optional[bytes] = None):
+        self.dictionary = dictionary
+        self.input = InputQueue()
+        self.decoder: Optional[ac.Decoder] = None
+        self.chain_model: Optional[ac.FlatMarkovModel] = None
+        self.expected_bytes = 0
+        self.produced = 0
+        # The last window of output, and anything not yet returned
+        self.output = bytearray()
+        self.unreturned = 0  # Where the bytes not yet returned start in output
+        self.held = b""
+        self.checksum: Optional[int] = None
+        self.returned_checksum = 0
+        self.eof = False
+        self.unconsumed_tail = b""
+
+    def decompress(self, data: bytes, max_length: int = 0) -> bytes:
+        held = self.held + data
+        self.input.queued += held[:-TRAILER_SIZE]
+        self.held = held[-TRAILER_SIZE:]
+        self.decode(max_length, False)
+        if max_length > 0 and len(self.output) - self.unreturned >= max_length:
+            self.unconsumed_tail = bytes(self.input.queued) + self.held
+            self.input.queued.clear()
+            self.held = b""
+        else:
+            self.unconsumed_tail = b""
+
+        return self.take(max_length)
+
+    def flush(self, length: int = 0) -> bytes:
+        # Everything left, treating the input as complete
+        if self.held:
+            stream, self.checksum = split_trailer(self.held)
+            self.input.queued += stream
+            self.held = b""
+
+        self.decode(length, True)
+        taken = self.take(length)
+        if self.eof and self.unreturned == len(self.output):
+            check_trailer(self.returned_checksum, self.checksum)
+
+        return taken
+
+    def decode(self, max_length: int, finished: bool) -> None:
+        if self.decoder is None and not self.start(finished):
+            return
+
+        decoder = self.decoder
+        chain_model = self.chain_model
+        while self.produced < self.expected_bytes:
+            if max_length > 0 and len(self.output) - self.unreturned >= max_length:
+                return
+
+            unread = self.input.taken + len(self.input.queued) - decoder.i
+            if not finished and unread < DECOMPRESS_MARGIN:
+                return
+
+            bit = decoder.decode(chain_model, 1)[0]
+            if bit == 0:
+                self.output += decode_literal(decoder, chain_model)
+                self.produced += 1
+            else:
+                offset, length = decode_backref(decoder, chain_model)
+                copy_backref(self.output, len(self.output), offset, length)
+                self.produced += length
+
+        self.eof = True
+
+    def start(self, finished: bool) -> bool:
+        queued = self.input.queued
+        headers = DICTIONARY_HEADER_SIZE + LAYOUT_HEADER_SIZE
+        if not finished and len(queued) < headers + DECOMPRESS_MARGIN:
+            return False
+
+        if is_framed(queued):
+            raise ValueError("framed streams can't be decompressed incrementally")
+
+        if stream_dictionary(queued) is not None:
+            header = bytes(queued[:DICTIONARY_HEADER_SIZE])
+            _, preset = split_dictionary(header, self.dictionary)
+            del queued[:DICTIONARY_HEADER_SIZE]
+            self.output += preset
+            self.unreturned = len(self.output)
+
+        layout = DEFAULT_LAYOUT
+        if is_tuned(queued):
+            layout = split_layout(bytes(queued[:LAYOUT_HEADER_SIZE]))[1]
+            del queued[:LAYOUT_HEADER_SIZE]
+
+        self.decoder = ac.Decoder(self.input)
+        self.chain_model, dummy_model = new_models(layout)
+        _ = int.from_bytes(decode_bytes(self.decoder, dummy_model, 4), "big")
+        self.expected_bytes = int.from_bytes(
+            decode_bytes(self.decoder, dummy_model, 4), "big"
+        )
+        return True
+
+    def take(self, max_length: int) -> bytes:
+        end = len(self.output)
+        if max_length > 0:
+            end = min(end, self.unreturned + max_length)
+
+        taken = bytes(self.output[self.unreturned : end])
+        self.returned_checksum = zlib.crc32(taken, self.returned_checksum)
+        self.unreturned = end
+        if self.unreturned > 2 * WINDOW_SIZE:
+            drop = self.unreturned - WINDOW_SIZE
+            del self.output[:drop]
+            self.unreturned -= drop
+
+        return taken
+
+
+def get_size(data: bytes) -> Tuple[bytes, int]:
+    bss_size = 0
+    bss_size = int.from_bytes(data[0:8], "little")
+    if bss_size > 2**32:  # We're probably dealing with a non-image
+        bss_size = 0
+    else:
+        data = data[8:]
+
+    print(bss_size, "extra bytes of BSS", sep="\t")
+
+    return data, len(data) + bss_size
+
+
+# Parse statistics can be gathered while packing as well as by decoding, and are kept in a side-car file next to the
+# packed output so info doesn't need to decode. Counts and distributions from separately coded blocks add up.
+PARSE_COUNTS = (
+    "control bits",
+    "literal bytes",
+    "offset bytes",
+    "extended offsets",
+    "length bytes",
+    "extended lengths",
+    "offset-length pairs",
+)
+SIDECAR_SUFFIX = ".stats"
+
+
+def distribution(values: List[int]) -> Dict[str, int]:
+    # How many values fall between each pair of powers of two
+    if np is not None and values:
+        buckets = np.bincount(np.log2(np.asarray(values)).astype(np.int64)).tolist()
+    else:
+        buckets = [0] * max(values, default=1).bit_length()
+        for value in values:
+            buckets[value.bit_length() - 1] += 1
+
+    return {
+        f"{1 << k}-{(2 << k) - 1}": count for k, count in enumerate(buckets) if count
+    }
+
+
+def parse_stats(
+    literal_count: int, offsets: List[int], lengths: List[int]
+) -> Dict[str, Any]:
+    if np is not None:
+        extended_offsets = int(np.count_nonzero(np.asarray(offsets) >= 0x80))
+        extended_lengths = int(np.count_nonzero(np.asarray(lengths) >= 0x80))
+    else:
+        extended_offsets = sum(offset >= 0x80 for offset in offsets)
+        extended_lengths = sum(length >= 0x80 for length in lengths)
+
+    pair_count = len(offsets)
+    return {
+        "control bits": literal_count + pair_count,
+        "literal bytes": literal_count,
+        "offset bytes": pair_count + extended_offsets,
+        "extended offsets": extended_offsets,
+        "length bytes": pair_count + extended_lengths,
+        "extended lengths": extended_lengths,
+        "offset-length pairs": pair_count,
+        "offsets": distribution(offsets),
+        "lengths": distribution(lengths),
+    }
+
+
+def memoization_stats(memoization: Memoization, start: int = 0) -> Dict[str, Any]:
+    literal_count = 0
+    offsets = []
+    lengths = []
+    i = start
+    while i < len(memoization):
+        if memoization.cbit[i] == 0:
+            literal_count += 1
+        else:
+            offsets.append(memoization.offset[i])
+            lengths.append(memoization.length[i])
+
+        i += memoization.length[i]
+
+    return parse_stats(literal_count, offsets, lengths)
+
+
+def merge_parse_stats(a: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
+    merged = {name: a[name] + b[name] for name in PARSE_COUNTS}
+    for name in ("offsets", "lengths"):
+        buckets = dict(a[name])
+        for bucket, count in b[name].items():
+            buckets[bucket] = buckets.get(bucket, 0) + count
+
+        merged[name] = dict(
+            sorted(buckets.items(), key=lambda item: int(item[0].split("-")[0]))
+        )
+
+    return merged
+
+
+STATS_CHUNK = 2**20
+
+
+def input_stats(data: bytes) -> Dict[str, Any]:
+    # A chunk at a time, to keep memory use down for memory-mapped input
+    histogram = [0] * 256
+    pairs = [0] * (256 * 256)
+    for start in range(0, len(data), STATS_CHUNK):
+        # Chunks overlap by a byte, so pairs across the boundaries get counted too
+        chunk = bytes(data[max(0, start - 1) : start + STATS_CHUNK])
+        chunk_histogram = ac.byte_histogram(chunk[1:] if start > 0 else chunk)
+        histogram = list(map(operator.add, histogram, chunk_histogram))
+        pairs = list(map(operator.add, pairs, ac.pair_histogram(chunk)))
+
+    return {
+        "order-0 entropy": ac.counts_entropy(histogram),
+        "order-1 entropy": ac.counts_conditional_entropy(pairs),
+        "byte histogram": histogram,
+    }
+
+
+def decode_stats(data: bytes) -> Tuple[int, int, Dict[str, Any]]:
+    # Back-references are only counted, so the dictionary isn't needed
+    if stream_dictionary(data) is not None:
+        data = data[DICTIONARY_HEADER_SIZE:]
+
+    data, layout = split_layout(data)
+    decoder = ac.Decoder(data)
+    chain_model, dummy_model = new_models(layout)
+
+    allocation_size = int.from_bytes(decode_bytes(decoder, dummy_model, 4), "big")
+    expected_bytes = int.from_bytes(decode_bytes(decoder, dummy_model, 4), "big")
+
+    bytes_counted = 0
+    literal_count = 0
+    offsets = []
+    lengths = []
+    while bytes_counted < expected_bytes:
+        bit = decoder.decode(chain_model, 1)[0]
+        if bit == 0:
+            decode_literal(decoder, chain_model)
+            literal_count += 1
+            bytes_counted += 1
+        else:
+            offset, length = decode_backref(decoder, chain_model)
+            offsets.append(offset)
+            lengths.append(length)
+            bytes_counted += length
+
+    return allocation_size, expected_bytes, parse_stats(literal_count, offsets, lengths)
+
+
+def print_parse_stats(
+    stats: Dict[str, Any], stream_size: int, expected_bytes: int
+) -> None:
+    for name in PARSE_COUNTS:
+        print(stats[name], name, sep="\t")
+
+    uncoded_length = (
+        math.ceil(stats["control bits"] / 8)
+        + stats["literal bytes"]
+        + stats["offset bytes"]
+        + stats["length bytes"]
+    )
+
+    print(uncoded_length, "bytes uncoded", sep="\t")
+    print(f"{100 * stream_size / uncoded_length :.2f}%\tcoding ratio")
+    print(f"{100 * uncoded_length / expected_bytes :.2f}%\tuncoded compression ratio")
+    print(f"{100 * stream_size / expected_bytes :.2f}%\ttotal compression ratio")
+    for name in ("offsets", "lengths"):
+        print(f"{name.capitalize()}:")
+        for bucket, count in stats[name].items():
+            print(f"\t{bucket}{' ' * (16 - len(bucket))}{count}")
+
+
+def info(data: bytes) -> None:
+    checksum = stream_dictionary(data)
+    if checksum is not None:
+        print(f"Preset dictionary: {checksum:08x}")
+        data = data[DICTIONARY_HEADER_SIZE:]
+
+    if is_tuned(data):
+        split_literals, shared_tail, byte_literals = split_layout(data)[1]
+        print(
+            f"Tuned chain layout: split_literals={split_literals}, shared_tail={shared_tail}, "
+            f"byte_literals={byte_literals}"
+        )
+
+    allocation_size, expected_bytes, stats = decode_stats(data)
+    print(allocation_size, "bytes allocated", sep="\t")
+    print(expected_bytes, "bytes expected", sep="\t")
+    print_parse_stats(stats, len(data), expected_bytes)
+
+
+# Streams coded with a chain layout other than the default start with a magic and a byte naming the layout, since the
+# decoder has to build the same chain. mini.asm only decodes the default layout, which never gets the header.
+TUNED_MAGIC = b"BWTU"
+LAYOUT_HEADER_SIZE = len(TUNED_MAGIC) + 1
+
+
+def is_tuned(encoded: bytes) -> bool:
+    return bytes(encoded[: len(TUNED_MAGIC)]) == TUNED_MAGIC
+
+
+def add_layout(stream: bytes, layout: Tuple[bool, bool, bool]) -> bytes:
+    if layout == DEFAULT_LAYOUT:
+        return stream
+
+    split_literals, shared_tail, byte_literals = layout
+    flags = split_literals | shared_tail << 1 | byte_literals << 2
+    return TUNED_MAGIC + bytes([flags]) + stream
+
+
+def split_layout(encoded: bytes) -> Tuple[bytes, Tuple[bool, bool, bool]]:
+    if not is_tuned(encoded):
+        return encoded, DEFAULT_LAYOUT
+
+    flags = encoded[len(TUNED_MAGIC)]
+    return encoded[LAYOUT_HEADER_SIZE:], (
+        bool(flags & 1),
+        bool(flags & 2),
+        bool(flags & 4),
+    )
+
+
+# A preset dictionary primes the window with bytes typical of the inputs, so back-references can reach into it from the
+# very first byte. Only its last window can be reached, which the encoder parses ahead of the input and the decoder puts
+# ahead of its output. Streams coded with one start with a magic and its CRC-32, outside any layout header, so decoders
+# can tell which dictionary they need. mini.asm has no dictionary to start from, so it can't decode them.
+DICTIONARY_MAGIC = b"BWDC"
+DICTIONARY_HEADER_SIZE = len(DICTIONARY_MAGIC) + 4
+DICTIONARY_SIZE = WINDOW_SIZE
+DICTIONARY_SEGMENT = 64
+DICTIONARY_KMER = 6
+
+
+def preset_window(dictionary: Optional[bytes]) -> bytes:
+    return bytes(dictionary[-WINDOW_SIZE:]) if dictionary else b""
+
+
+def stream_dictionary(encoded: bytes) -> Optional[int]:
+    # The CRC-32 of the dictionary a stream was coded with, if any
+    if len(encoded) < DICTIONARY_HEADER_SIZE:
+        return None
+
+    if bytes(encoded[: len(DICTIONARY_MAGIC)]) != DICTIONARY_MAGIC:
+        return None
+
+    return int.from_bytes(
+        encoded[len(DICTIONARY_MAGIC) : DICTIONARY_HEADER_SIZE], "big"
+    )
+
+
+def add_dictionary(stream: bytes, dictionary: Optional[bytes]) -> bytes:
+    if not dictionary:
+        return stream
+
+    return DICTIONARY_MAGIC + zlib.crc32(dictionary).to_bytes(4, "big") + stream
+
+
+def split_dictionary(
+    encoded: bytes, dictionary: Optional[bytes]
+) -> Tuple[bytes, bytes]:
+    # The stream after the header and the bytes to start the decoder's history with
+    checksum = stream_dictionary(encoded)
+    if checksum is None:
+        return encoded, b""
+
+    if dictionary is None:
+        raise ValueError(f"stream needs dictionary {checksum:08x}")
+
+    if zlib.crc32(dictionary) != checksum:
+        raise ValueError(
+            f"stream needs dictionary {checksum:08x}, not {zlib.crc32(dictionary):08x}"
+        )
+
+    return encoded[DICTIONARY_HEADER_SIZE:], preset_window(dictionary)
+
+
+def build_dictionary(
+    samples: List[bytes],
+    size: int = DICTIONARY_SIZE,
+    segment_size: int = DICTIONARY_SEGMENT,
+    k: int = DICTIONARY_KMER,
+) -> bytes:
+    # Cuts the samples into segments and greedily picks whichever covers the most k-byte strings that also turn up in
+    # other samples, counting each string only once over all the picks. Picking a segment only ever lowers the others'
+    # scores, so stale scores are upper bounds and only the top of the heap needs rescoring. The best segments go last,
+    # closest to the input and so reachable with the shortest offsets.
+    frequency: Dict[bytes, int] = {}
+    for sample in samples:
+        for kmer in {sample[i : i + k] for i in range(len(sample) - k + 1)}:
+            frequency[kmer] = frequency.get(kmer, 0) + 1
+
+    def score(segment: bytes) -> int:
+        kmers = {segment[i : i + k] for i in range(len(segment) - k + 1)}
+        return sum(frequency[kmer] - 1 for kmer in kmers)
+
+    segments = [
+        sample[i : i + segment_size]
+        for sample in samples
+        for i in range(0, len(sample), segment_size)
+    ]
+    heap = [(-score(segment), n) for n, segment in enumerate(segments)]
+    heapq.heapify(heap)
+
+    chosen: List[bytes] = []
+    total = 0
+    while heap and total < size:
+        _, n = heapq.heappop(heap)
+        current = score(segments[n])
+        if current <= 0:
+            continue
+
+        if heap and -current > heap[0][0]:
+            heapq.heappush(heap, (-current, n))
+            continue
+
+        segment = segments[n][: size - total]
+        chosen.append(segment)
+        total += len(segment)
+        for i in range(len(segment) - k + 1):
+            frequency[segment[i : i + k]] = 1
+
+    return b"".join(reversed(chosen))
+
+
+# Auto-tuning codes the input under every combination of parameters in a grid, in parallel, and keeps whichever codes
+# smallest. Window size and minimum match length only steer the parse, so only the layout needs recording in the stream.
+# Ties go to the earliest combination, so the default layout comes first.
+TUNING_GRID: Dict[str, List[Any]] = {
+    "layout": [
+        [False, True, False],
+        [True, True, False],
+        [False, False, False],
+        [True, False, False],
+        [False, True, True],
+        [False, False, True],
+    ],
+    "window_size": [2**12 - 1, 2**13 - 1, 2**14 - 1, 2**15 - 1],
+    "min_match": [3, 4],
+}
+
+
+def tune_candidate(
+    data: bytes,
+    allocation_size: int,
+    level: int,
+    passes: int,
+    dictionary: Optional[bytes],
+    config: Dict[str, Any],
+) -> Tuple[bytes, Dict[str, Any], Dict[str, Any]]:
+    stats: Dict[str, Any] = {}
+    analysis: Dict[str, Any] = {}
+    encoded = encode(
+        data,
+        allocation_size,
+        verbose=False,
+        stats=stats,
+        passes=passes,
+        analysis=analysis,
+        level=level,
+        dictionary=dictionary,
+        **config,
+    )
+
+    return encoded, stats, analysis
+
+
+def tune(
+    data: bytes,
+    allocation_size: int,
+    grid: Dict[str, List[Any]] = TUNING_GRID,
+    jobs: Optional[int] = None,
+    verbose: bool = True,
+    stats: Optional[Dict[str, Any]] = None,
+    passes: int = 1,
+    analysis: Optional[Dict[str, Any]] = None,
+    level: int = DEFAULT_LEVEL,
+    dictionary: Optional[bytes] = None,
+) -> bytes:
+    configs = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+    for config in configs:
+        if "layout" in config:
+            # Grids from before byte literals name only the first two flags
+            layout = tuple(config["layout"])
+            config["layout"] = layout + DEFAULT_LAYOUT[len(layout) :]
+
+    candidate = functools.partial(
+        tune_candidate, data, allocation_size, level, passes, dictionary
+    )
+    with ProcessPoolExecutor(jobs, initializer=new_models) as pool:
+        results = list(pool.map(candidate, configs))
+
+    best = min(range(len(results)), key=lambda n: len(results[n][0]))
+    encoded, encode_stats, encode_analysis = results[best]
+    config = configs[best]
+    tuned_stats = {
+        "window size": config.get("window_size", WINDOW_SIZE),
+        "minimum match": config.get("min_match", MIN_MATCH),
+        "split literals": int(config.get("layout", DEFAULT_LAYOUT)[0]),
+        "shared tail": int(config.get("layout", DEFAULT_LAYOUT)[1]),
+        "byte literals": int(config.get("layout", DEFAULT_LAYOUT)[2]),
+        "configurations tried": len(configs),
+    }
+
+    tuned_stats.update(encode_stats)
+    if stats is not None:
+        stats.update(tuned_stats)
+
+    if analysis is not None:
+        analysis.update(encode_analysis)
+
+    if verbose:
+        print_stats(tuned_stats)
+
+    return encoded
+
+
+# The framed container cuts the input into blocks that are coded as independent streams, so they can be packed and
+# unpacked in parallel. The mini.asm decompressor only understands a single stream, which stays the default. No
+# plausible single stream starts with the magic, since its first byte is the top byte of the allocation size.
+FRAME_MAGIC = b"BWFR"
+FRAME_BLOCK_SIZE = 2**18
+
+
+def is_framed(encoded: bytes) -> bool:
+    return encoded[: len(FRAME_MAGIC)] == FRAME_MAGIC
+
+
+def encode_block(
+    block: bytes,
+    passes: int = 1,
+    level: int = DEFAULT_LEVEL,
+    layout: Tuple[bool, bool, bool] = DEFAULT_LAYOUT,
+    dictionary: Optional[bytes] = None,
+) -> Tuple[bytes, Dict[str, Any]]:
+    analysis: Dict[str, Any] = {}
+    stream = encode(
+        block,
+        len(block),
+        verbose=False,
+        passes=passes,
+        analysis=analysis,
+        level=level,
+        layout=layout,
+        dictionary=dictionary,
+    )
+    return stream, analysis
+
+
+def encode_framed(
+    data: bytes,
+    allocation_size: int,
+    block_size: int = FRAME_BLOCK_SIZE,
+    jobs: Optional[int] = None,
+    verbose: bool = True,
+    stats: Optional[Dict[str, Any]] = None,
+    passes: int = 1,
+    analysis: Optional[Dict[str, Any]] = None,
+    level: int = DEFAULT_LEVEL,
+    layout: Tuple[bool, bool, bool] = DEFAULT_LAYOUT,
+    dictionary: Optional[bytes] = None,
+) -> bytes:
+    # Every block starts from the same dictionary, if there is one
+    blocks = [data[i : i + block_size] for i in range(0, len(data), block_size)]
+    with ProcessPoolExecutor(jobs) as pool:
+        results = list(
+            pool.map(
+                encode_block,
+                blocks,
+                [passes] * len(blocks),
+                [level] * len(blocks),
+                [layout] * len(blocks),
+                [dictionary] * len(blocks),
+            )
+        )
+
+    streams = [stream for stream, _ in results]
+    if analysis is not None:
+        merged = parse_stats(0, [], [])
+        for _, block_analysis in results:
+            merged = merge_parse_stats(merged, block_analysis)
+
+        analysis.update(merged)
+
+    header = FRAME_MAGIC
+    header += allocation_size.to_bytes(4, "big")
+    header += len(data).to_bytes(4, "big")
+    header += len(blocks).to_bytes(4, "big")
+    offset = len(header) + 12 * len(blocks)
+    for block, stream in zip(blocks, streams):
+        header += offset.to_bytes(4, "big")
+        header += len(stream).to_bytes(4, "big")
+        header += len(block).to_bytes(4, "big")
+        offset += len(stream)
+
+    framed = header + b"".join(streams)
+    frame_stats = {"bytes compressed": len(framed), "blocks": len(blocks)}
+    if stats is not None:
+        stats.update(frame_stats)
+
+    if verbose:
+        print_stats(frame_stats)
+
+    return framed
+
+
+def read_frame_index(encoded: bytes) -> Tuple[int, int, List[Tuple[int, int, int]]]:
+    assert is_framed(encoded)
+    fields = len(FRAME_MAGIC)
+    allocation_size = int.from_bytes(encoded[fields : fields + 4], "big")
+    expected_bytes = int.from_bytes(encoded[fields + 4 : fields + 8], "big")
+    block_count = int.from_bytes(encoded[fields + 8 : fields + 12], "big")
+    index = []
+    for n in range(block_count):
+        entry = fields + 12 + 12 * n
+        offset = int.from_bytes(encoded[entry : entry + 4], "big")
+        size = int.from_bytes(encoded[entry + 4 : entry + 8], "big")
+        decoded_size = int.from_bytes(encoded[entry + 8 : entry + 12], "big")
+        index.append((offset, size, decoded_size))
+
+    return allocation_size, expected_bytes, index
+
+
+def decode_framed(
+    encoded: bytes, jobs: Optional[int] = None, dictionary: Optional[bytes] = None
+) -> bytes:
+    encoded, checksum = split_trailer(encoded)
+    _, expected_bytes, index = read_frame_index(encoded)
+    streams = [encoded[offset : offset + size] for offset, size, _ in index]
+    with ProcessPoolExecutor(jobs) as pool:
+        blocks = list(pool.map(decode, streams, [dictionary] * len(streams)))
+
+    for n, (block, (_, _, decoded_size)) in enumerate(zip(blocks, index)):
+        if len(block) != decoded_size:
+            raise ValueError(
+                f"block {n} decoded to {len(block)} bytes, {decoded_size} expected"
+            )
+
+    decompressed = b"".join(blocks)
+    if len(decompressed) != expected_bytes:
+        raise ValueError(
+            f"frame decoded to {len(decompressed)} bytes, {expected_bytes} expected"
+        )
+
+    check_trailer(zlib.crc32(decompressed), checksum)
+    return decompressed
+
+
+def info_framed(encoded: bytes) -> None:
+    allocation_size, expected_bytes, index = read_frame_index(encoded)
+    print(allocation_size, "bytes allocated", sep="\t")
+    print(expected_bytes, "bytes expected", sep="\t")
+    print(len(index), "blocks", sep="\t")
+    for n, (offset, size, decoded_size) in enumerate(index):
+        print(f"Block {n}: {size} bytes at {offset}, {decoded_size} bytes decoded")
+        info(encoded[offset : offset + size])
+
+
+# Packs verified by sampling only decode their first SAMPLE_SIZE bytes, and carry a trailer with a checksum of the
+# whole input so unpacking can check the rest. Trailers need stripping before a stream goes anywhere near mini.asm,
+# which inc.py takes care of.
+TRAILER_MAGIC = b"BWCK"
+TRAILER_SIZE = 4 + len(TRAILER_MAGIC)
+SAMPLE_SIZE = 2**16
+
+
+def add_trailer(encoded: bytes, data: bytes) -> bytes:
+    return encoded + zlib.crc32(data).to_bytes(4, "big") + TRAILER_MAGIC
+
+
+def split_trailer(encoded: bytes) -> Tuple[bytes, Optional[int]]:
+    if len(encoded) < TRAILER_SIZE or encoded[-len(TRAILER_MAGIC) :] != TRAILER_MAGIC:
+        return encoded, None
+
+    checksum = int.from_bytes(encoded[-TRAILER_SIZE : -len(TRAILER_MAGIC)], "big")
+    return encoded[:-TRAILER_SIZE], checksum
+
+
+def check_trailer(decoded_checksum: int, checksum: Optional[int]) -> None:
+    if checksum is not None and decoded_checksum != checksum:
+        raise ValueError("output doesn't match the checksum in the trailer")
+
+
+def verify_sample(
+    encoded: bytes, data: bytes, dictionary: Optional[bytes] = None
+) -> bool:
+    if is_framed(encoded):
+        _, _, index = read_frame_index(encoded)
+        if len(index) == 0:
+            return len(data) == 0
+
+        offset, size, sample_size = index[0]
+        sample = decode(encoded[offset : offset + size], dictionary)
+    else:
+        sample_size = min(len(data), SAMPLE_SIZE)
+        sample = next(iter_decode(encoded, SAMPLE_SIZE, dictionary=dictionary), b"")
+
+    return len(sample) >= sample_size and data[: len(sample)] == sample
+
+
+def decodes_to(
+    encoded: bytes, checksum: int, dictionary: Optional[bytes] = None
+) -> bool:
+    # Runs in a worker of its own, so framed blocks are decoded one after another
+    if is_framed(encoded):
+        _, _, index = read_frame_index(encoded)
+        blocks = (
+            decode(encoded[offset : offset + size], dictionary)
+            for offset, size, _ in index
+        )
+    else:
+        blocks = iter_decode(encoded, dictionary=dictionary)
+
+    decoded_checksum = 0
+    for block in blocks:
+        decoded_checksum = zlib.crc32(block, decoded_checksum)
+
+    return decoded_checksum == checksum
+
+
+# Checkpoint indexes let decode_range() start decoding part way through a single stream. Every so many output bytes,
+# at the first packet boundary past the mark, the index records the decoder and chain model states and as much of the
+# preceding output as back-references from there can reach. They're built by decoding the finished stream, so they go in
+# a side-car next to it and the stream itself stays exactly as mini.asm expects.
+INDEX_MAGIC = b"BWIX"
+INDEX_SUFFIX = ".index"
+CHECKPOINT_INTERVAL = 2**20
+
+
+def encode_checkpoint(
+    position: int,
+    decoder_state: Tuple[int, int, int, int],
+    model_state: Tuple[int, List[int]],
+    history: bytes,
+) -> bytes:
+    a, b, window, i = decoder_state
+    node, counts = model_state
+    entry = position.to_bytes(4, "big")
+    entry += a.to_bytes(8, "big") + b.to_bytes(8, "big") + window.to_bytes(8, "big")
+    entry += i.to_bytes(4, "big")
+    entry += node.to_bytes(4, "big")
+    entry += len(counts).to_bytes(4, "big")
+    entry += b"".join(count.to_bytes(4, "big") for count in counts)
+    entry += len(history).to_bytes(4, "big")
+    return entry + history
+
+
+def build_index(
+    encoded: bytes,
+    interval: int = CHECKPOINT_INTERVAL,
+    dictionary: Optional[bytes] = None,
+) -> bytes:
+    stream, preset = split_dictionary(encoded, dictionary)
+    stream, layout = split_layout(stream)
+    decoder = ac.Decoder(stream)
+    chain_model, dummy_model = new_models(layout)
+    _ = int.from_bytes(decode_bytes(decoder, dummy_model, 4), "big")
+    expected_bytes = int.from_bytes(decode_bytes(decoder, dummy_model, 4), "big")
+
+    # Only the last window of output is kept, and each checkpoint takes a copy of it that gets cut down to what the
+    # back-references starting within a window of the checkpoint actually reach, dictionary included
+    checkpoints: List[List[Any]] = []
+    history = bytearray(preset)
+    base = 0  # Output position of history[0]
+    n = 0
+    while n < expected_bytes:
+        if n >= (checkpoints[-1][0] if checkpoints else 0) + interval:
+            window = bytes(history[max(0, len(history) - WINDOW_SIZE) :])
+            checkpoints.append([n, decoder.state(), chain_model.state(), window, n])
+
+        bit = decoder.decode(chain_model, 1)[0]
+        if bit == 0:
+            history += decode_literal(decoder, chain_model)
+            n += 1
+        else:
+            offset, length = decode_backref(decoder, chain_model)
+            copy_backref(history, len(history), offset, length)
+            source = n - offset
+            n += length
+            k = len(checkpoints) - 1
+            while k >= 0 and checkpoints[k][0] > source:
+                checkpoints[k][4] = min(checkpoints[k][4], source)
+                k -= 1
+
+        if len(history) > 2 * WINDOW_SIZE:
+            base += len(history) - WINDOW_SIZE
+            del history[: len(history) - WINDOW_SIZE]
+
+    entries = [
+        encode_checkpoint(
+            position,
+            decoder_state,
+            model_state,
+            window[len(window) + reach - position :],
+        )
+        for position, decoder_state, model_state, window, reach in checkpoints
+    ]
+
+    header = INDEX_MAGIC
+    header += zlib.crc32(encoded).to_bytes(4, "big")
+    header += expected_bytes.to_bytes(4, "big")
+    header += len(entries).to_bytes(4, "big")
+    offset = len(header) + 12 * len(entries)
+    for (position, *_), entry in zip(checkpoints, entries):
+        header += position.to_bytes(4, "big")
+        header += offset.to_bytes(4, "big")
+        header += len(entry).to_bytes(4, "big")
+        offset += len(entry)
+
+    return header + b"".join(entries)
+
+
+class CheckpointIndex:
+    # Only the table is read up front, checkpoints are unpacked as they're needed
+    def __init__(self, index: bytes):
+        assert index[: len(INDEX_MAGIC)] == INDEX_MAGIC
+        fields = len(INDEX_MAGIC)
+        self.index = index
+        self.checksum = int.from_bytes(index[fields : fields + 4], "big")
+        self.expected_bytes = int.from_bytes(index[fields + 4 : fields + 8], "big")
+        count = int.from_bytes(index[fields + 8 : fields + 12], "big")
+        self.positions = []
+        self.entries = []
+        for k in range(count):
+            entry = fields + 12 + 12 * k
+            self.positions.append(int.from_bytes(index[entry : entry + 4], "big"))
+            offset = int.from_bytes(index[entry + 4 : entry + 8], "big")
+            size = int.from_bytes(index[entry + 8 : entry + 12], "big")
+            self.entries.append((offset, size))
+
+    def find(self, position: int) -> Optional[int]:
+        # The last checkpoint at or before position, if any
+        k = bisect.bisect_right(self.positions, position) - 1
+        return k if k >= 0 else None
+
+    def checkpoint(
+        self, k: int
+    ) -> Tuple[int, Tuple[int, int, int, int], Tuple[int, List[int]], bytes]:
+        offset, size = self.entries[k]
+        entry = self.index[offset : offset + size]
+        fields = [int.from_bytes(entry[j : j + 8], "big") for j in (4, 12, 20)]
+        i = int.from_bytes(entry[28:32], "big")
+        node = int.from_bytes(entry[32:36], "big")
+        count = int.from_bytes(entry[36:40], "big")
+        counts_end = 40 + 4 * count
+        counts = [
+            int.from_bytes(entry[j : j + 4], "big") for j in range(40, counts_end, 4)
+        ]
+        history_size = int.from_bytes(entry[counts_end : counts_end + 4], "big")
+        history = entry[counts_end + 4 : counts_end + 4 + history_size]
+        decoder_state = (fields[0], fields[1], fields[2], i)
+        return self.positions[k], decoder_state, (node, counts), history
+
+
+def write_index(
+    path: str, encoded: bytes, interval: int, dictionary: Optional[bytes] = None
+) -> None:
+    stream, _ = split_trailer(encoded)
+    with open(path + INDEX_SUFFIX, "wb") as wf:
+        wf.write(build_index(stream, interval, dictionary))
+
+
+def read_index(path: str, encoded: bytes) -> Optional[CheckpointIndex]:
+    # Only trusted while it still describes the stream next to it, like the statistics side-car
+    try:
+        with open(path + INDEX_SUFFIX, "rb") as rf:
+            index = CheckpointIndex(rf.read())
+    except (OSError, AssertionError):
+        return None
+
+    if index.checksum != zlib.crc32(encoded):
+        return None
+
+    return index
+
+
+def decode_range(
+    encoded: bytes,
+    start: int,
+    length: int,
+    index: Optional[CheckpointIndex] = None,
+    dictionary: Optional[bytes] = None,
+) -> bytes:
+    # Output bytes start to start + length, decoding from the last checkpoint before start if there's an index for the
+    # stream, and only keeping as much history as back-references can reach on the way. Framed streams only decode the
+    # blocks the range overlaps. Any trailer is left out, since only the whole output could be checked against it.
+    encoded, _ = split_trailer(encoded)
+    if is_framed(encoded):
+        _, _, frame_index = read_frame_index(encoded)
+        blocks = []
+        skipped = 0  # Output bytes in the blocks before the first one decoded
+        block_start = 0
+        for offset, size, decoded_size in frame_index:
+            block_end = block_start + decoded_size
+            if block_start < start + length and start < block_end:
+                if not blocks:
+                    skipped = block_start
+
+                blocks.append(decode(encoded[offset : offset + size], dictionary))
+
+            block_start = block_end
+
+        return b"".join(blocks)[start - skipped : start - skipped + length]
+
+    stream, preset = split_dictionary(encoded, dictionary)
+    stream, layout = split_layout(stream)
+    decoder = ac.Decoder(stream, counting=active_profile is not None)
+    chain_model, dummy_model = new_models(layout)
+    k = None if index is None else index.find(start)
+    if k is None:
+        _ = int.from_bytes(decode_bytes(decoder, dummy_model, 4), "big")
+        expected_bytes = int.from_bytes(decode_bytes(decoder, dummy_model, 4), "big")
+        n, history = 0, bytearray(preset)
+    else:
+        n, decoder_state, model_state, window = index.checkpoint(k)
+        decoder.restore(decoder_state)
+        chain_model.restore(*model_state)
+        expected_bytes = index.expected_bytes
+        history = bytearray(window)
+
+    base = n - len(history)  # Output position of history[0]
+    end = min(start + length, expected_bytes)
+    while n < end:
+        bit = decoder.decode(chain_model, 1)[0]
+        if bit == 0:
+            history += decode_literal(decoder, chain_model)
+            n += 1
+        else:
+            offset, count = decode_backref(decoder, chain_model)
+            copy_backref(history, len(history), offset, count)
+            n += count
+
+        if n < start and len(history) > 2 * WINDOW_SIZE:
+            base += len(history) - WINDOW_SIZE
+            del history[: len(history) - WINDOW_SIZE]
+
+    count_decoder_events(decoder)
+    return bytes(history[max(0, start - base) : max(0, end - base)])
+
+
+# Packs are keyed by everything that can change their output: the input, the allocation size, the options, and the
+# version of the coder. It has to go up with any change to the streams, model templates or parses the coder produces,
+# ac.py's included, which invalidates cached packs, templates.json and .parse files. Edits that don't, to the command
+# line or the server say, leave them all usable.
+DEFAULT_CACHE_DIR = ".bitweaver-cache"
+CACHE_DIR = os.environ.get("BITWEAVER_CACHE", DEFAULT_CACHE_DIR)
+CACHE_SIZE = 2**26
+CODER_VERSION = 1
+
+
+class PackCache:
+    def __init__(self, path: str = CACHE_DIR, max_size: int = CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    def key(self, data: bytes, allocation_size: int, options: Dict[str, Any]) -> str:
+        digest = hashlib.sha256(data)
+        digest.update(allocation_size.to_bytes(8, "big"))
+        digest.update(json.dumps(options, sort_keys=True).encode())
+        digest.update(CODER_VERSION.to_bytes(4, "big"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[bytes, Dict[str, Any], Dict[str, Any]]]:
+        stream_path = os.path.join(self.path, key + ".bw")
+        try:
+            with open(stream_path, "rb") as rf:
+                encoded = rf.read()
+
+            with open(os.path.join(self.path, key + ".json"), "r") as rf:
+                summary = json.load(rf)
+
+            stats = summary["stats"]
+            analysis = summary["analysis"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+        os.utime(stream_path)  # Marks the entry as recently used
+        return encoded, stats, analysis
+
+    def put(
+        self, key: str, encoded: bytes, stats: Dict[str, Any], analysis: Dict[str, Any]
+    ) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        # The stats go in first, since a stream without them doesn't count as an entry
+        summary = {"stats": stats, "analysis": analysis}
+        for suffix, contents in (
+            (".json", json.dumps(summary).encode()),
+            (".bw", encoded),
+        ):
+            temp_path = os.path.join(self.path, f"{key}{suffix}.{os.getpid()}.tmp")
+            with open(temp_path, "wb") as wf:
+                wf.write(contents)
+
+            os.replace(temp_path, os.path.join(self.path, key + suffix))
+
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(".bw"):
+                key = name[: -len(".bw")]
+                try:
+                    stream = os.stat(os.path.join(self.path, name))
+                    summary = os.stat(os.path.join(self.path, key + ".json"))
+                except OSError:
+                    continue
+
+                entries.append((stream.st_mtime, stream.st_size + summary.st_size, key))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            for suffix in (".bw", ".json"):
+                try:
+                    os.remove(os.path.join(self.path, key + suffix))
+                except OSError:
+                    pass
+
+            total_size -= size
+
+
+# Incremental packs keep the input and its parse next to the output, so the next pack of a slightly different input only
+# has to parse around the edits. They're only reused by the same version of the coder.
+PARSE_MAGIC = b"BWPA"
+PARSE_SUFFIX = ".parse"
+
+
+def write_parse(path: str, incremental: Dict[str, Any]) -> None:
+    if not incremental:
+        return
+
+    memoization = incremental["memoization"]
+    header = {
+        "version": CODER_VERSION,
+        "byteorder": sys.byteorder,
+        "settings": incremental["settings"],
+        "size": len(incremental["data"]),
+    }
+    with open(path + PARSE_SUFFIX, "wb") as wf:
+        wf.write(PARSE_MAGIC + json.dumps(header).encode() + b"\n")
+        wf.write(incremental["data"])
+        for parsed in (
+            memoization.cbit,
+            memoization.offset,
+            memoization.length,
+            memoization.cost,
+            memoization.span,
+        ):
+            wf.write(parsed.tobytes())
+
+
+def read_parse(path: str) -> Dict[str, Any]:
+    # Anything unreadable or out of date just means parsing from scratch
+    try:
+        with open(path + PARSE_SUFFIX, "rb") as rf:
+            if rf.read(len(PARSE_MAGIC)) != PARSE_MAGIC:
+                return {}
+
+            header = json.loads(rf.readline())
+            if (
+                header["version"] != CODER_VERSION
+                or header["byteorder"] != sys.byteorder
+            ):
+                return {}
+
+            size = header["size"]
+            data = rf.read(size)
+            memoization = Memoization(0)
+            for parsed in (
+                memoization.cbit,
+                memoization.offset,
+                memoization.length,
+                memoization.cost,
+                memoization.span,
+            ):
+                parsed.frombytes(rf.read(parsed.itemsize * size))
+    except (OSError, ValueError, KeyError):
+        return {}
+
+    if len(data) != size or len(memoization.span) != size:
+        return {}
+
+    return {"settings": header["settings"], "data": data, "memoization": memoization}
+
+
+def write_sidecar(
+    path: str,
+    encoded: bytes,
+    data: bytes,
+    allocation_size: int,
+    analysis: Dict[str, Any],
+) -> None:
+    stream, _ = split_trailer(encoded)
+    sidecar = {
+        "stream checksum": zlib.crc32(encoded),
+        "stream size": len(stream),
+        "bytes allocated": allocation_size,
+        "bytes expected": len(data),
+        "blocks": len(read_frame_index(stream)[2]) if is_framed(stream) else None,
+        "parse": analysis,
+        "input": input_stats(data),
+    }
+
+    with open(path + SIDECAR_SUFFIX, "w") as wf:
+        json.dump(sidecar, wf, separators=(",", ":"))
+
+
+def read_sidecar(path: str, encoded: bytes) -> Optional[Dict[str, Any]]:
+    # Only trusted while it still describes the stream next to it
+    try:
+        with open(path + SIDECAR_SUFFIX, "r") as rf:
+            sidecar = json.load(rf)
+    except (OSError, ValueError):
+        return None
+
+    if sidecar.get("stream checksum") != zlib.crc32(encoded):
+        return None
+
+    return sidecar
+
+
+def print_sidecar(sidecar: Dict[str, Any]) -> None:
+    print(sidecar["bytes allocated"], "bytes allocated", sep="\t")
+    print(sidecar["bytes expected"], "bytes expected", sep="\t")
+    if sidecar["blocks"] is not None:
+        print(sidecar["blocks"], "blocks", sep="\t")
+
+    stream_size = sidecar["stream size"]
+    print_parse_stats(sidecar["parse"], stream_size, sidecar["bytes expected"])
+
+    histogram = sidecar["input"]["byte histogram"]
+    print(sum(count > 0 for count in histogram), "distinct bytes", sep="\t")
+    for name in ("order-0 entropy", "order-1 entropy"):
+        print(f"{sidecar['input'][name] :.4f}\t{name} (bits per byte)")
+
+
+def read_dictionary(path: Optional[str]) -> Optional[bytes]:
+    if path is None:
+        return None
+
+    with open(path, "rb") as rf:
+        return rf.read()
+
+
+def pack_file(args: argparse.Namespace) -> None:
+    if args.memory_limit is not None and (args.block_size or args.passes > 1):
+        print("--memory-limit only works with a single stream and a single pass")
+        sys.exit(2)
+
+    if args.tune is not None and (args.block_size or args.memory_limit is not None):
+        print("--tune only works with a single stream held in memory")
+        sys.exit(2)
+
+    if args.incremental and (
+        args.block_size or args.memory_limit is not None or args.tune is not None
+    ):
+        print("--incremental only works with a single stream held in memory")
+        sys.exit(2)
+
+    if args.tune is not None and args.byte_literals:
+        print("--tune picks the chain layout itself, byte literals included")
+        sys.exit(2)
+
+    if args.checkpoints is not None and args.block_size:
+        print(
+            "--checkpoints only works with a single stream, framed ones seek by block"
+        )
+        sys.exit(2)
+
+    with open(args.input, "rb") as rf:
+        if args.memory_limit is None or os.fstat(rf.fileno()).st_size == 0:
+            pack_data(args, rf.read())
+            return
+
+        # Only the pages being hashed, parsed or checked at the time need to be resident
+        with mmap.mmap(rf.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            try:
+                pack_data(args, memoryview(mapped))
+            except BaseException as e:
+                # Views of the mapping live on in the traceback's frames, and it can't be closed while they do
+                traceback.clear_frames(e.__traceback__)
+                raise
+
+
+def pack_data(args: argparse.Namespace, data: bytes) -> None:
+    data, full_size = get_size(data)
+    dictionary = read_dictionary(args.dictionary)
+    options = {
+        "block_size": args.block_size,
+        "passes": args.passes,
+        "trailer": args.verify == "sampled",
+        "memory_limit": args.memory_limit,
+        "level": args.level,
+        "tune": args.tune,
+        "byte_literals": args.byte_literals,
+        "dictionary": zlib.crc32(dictionary) if dictionary else None,
+    }
+    layout = BYTE_LITERALS_LAYOUT if args.byte_literals else DEFAULT_LAYOUT
+    cache = PackCache(args.cache, args.cache_size) if args.cache else None
+    key = cache.key(data, full_size, options) if cache else ""
+    cached = cache.get(key) if cache else None
+    if cached is not None:
+        encoded, stats, analysis = cached
+        print("Cache hit")
+        print_stats(stats)
+    else:
+        stats = {}
+        analysis: Dict[str, Any] = {}
+        if args.block_size is not None:
+            encoded = encode_framed(
+                data,
+                full_size,
+                args.block_size,
+                args.jobs,
+                stats=stats,
+                passes=args.passes,
+                analysis=analysis,
+                level=args.level,
+                layout=layout,
+                dictionary=dictionary,
+            )
+        elif args.tune is not None:
+            with stage("tuning"):
+                encoded = tune(
+                    data,
+                    full_size,
+                    args.tune,
+                    args.jobs,
+                    stats=stats,
+                    passes=args.passes,
+                    analysis=analysis,
+                    level=args.level,
+                    dictionary=dictionary,
+                )
+        elif args.memory_limit is not None:
+            with stage("encode"):
+                encoded = encode_segmented(
+                    data,
+                    full_size,
+                    args.memory_limit,
+                    stats=stats,
+                    analysis=analysis,
+                    level=args.level,
+                    layout=layout,
+                    dictionary=dictionary,
+                )
+        else:
+            incremental = read_parse(args.output) if args.incremental else None
+            with stage("encode"):
+                encoded = encode(
+                    data,
+                    full_size,
+                    stats=stats,
+                    passes=args.passes,
+                    analysis=analysis,
+                    level=args.level,
+                    layout=layout,
+                    incremental=incremental,
+                    dictionary=dictionary,
+                )
+
+            if incremental is not None:
+                if incremental:
+                    print(incremental["reparsed"], "positions parsed", sep="\t")
+
+                write_parse(args.output, incremental)
+
+        with stage("verification"):
+            if args.verify == "full":
+                if args.memory_limit is not None:
+                    verified = decodes_to(encoded, zlib.crc32(data), dictionary)
+                elif is_framed(encoded):
+                    try:
+                        verified = decode_framed(encoded, args.jobs, dictionary) == data
+                    except ValueError:
+                        verified = False
+                else:
+                    verified = decode(encoded, dictionary) == data
+            elif args.verify == "sampled":
+                verified = verify_sample(encoded, data, dictionary)
+                encoded = add_trailer(encoded, data)
+            else:
+                verified = True  # For now, see below
+
+        if not verified:
+            print("Stream corruption detected!")
+            sys.exit(1)
+
+    print(f"{100 * len(encoded) / len(data) :.2f}%\tcompression ratio")
+    if cached is None and args.verify == "async":
+        # The stream only takes the output's place once a worker has decoded it in full
+        temp_path = args.output + ".tmp"
+        with ProcessPoolExecutor(1) as pool:
+            decoding = pool.submit(decodes_to, encoded, zlib.crc32(data), dictionary)
+            with open(temp_path, "wb") as wf:
+                wf.write(encoded)
+
+            if not decoding.result():
+                os.remove(temp_path)
+                print("Stream corruption detected!")
+                sys.exit(1)
+
+        os.replace(temp_path, args.output)
+    else:
+        with open(args.output, "wb") as wf:
+            wf.write(encoded)
+
+    write_sidecar(args.output, encoded, data, full_size, analysis)
+    if args.checkpoints is not None:
+        with stage("indexing"):
+            write_index(args.output, encoded, args.checkpoints, dictionary)
+
+    if cache and cached is None:
+        cache.put(key, encoded, stats, analysis)
+
+
+def unpack_file(args: argparse.Namespace) -> None:
+    if args.range is not None:
+        unpack_range(args)
+        return
+
+    dictionary = read_dictionary(args.dictionary)
+    with stage("decode"), open(args.input, "rb") as rf, open(args.output, "wb") as wf:
+        framed = is_framed(rf.read(len(FRAME_MAGIC)))
+        size = rf.seek(0, os.SEEK_END)
+        rf.seek(max(0, size - TRAILER_SIZE))
+        _, checksum = split_trailer(rf.read())
+        if checksum is not None:
+            size -= TRAILER_SIZE
+
+        rf.seek(0)
+        decoded_checksum = 0
+        try:
+            if framed:
+                decoded = decode_framed(rf.read(size), args.jobs, dictionary)
+                decoded_checksum = zlib.crc32(decoded)
+                wf.write(decoded)
+            else:
+                for chunk in iter_decode(rf, length=size, dictionary=dictionary):
+                    decoded_checksum = zlib.crc32(chunk, decoded_checksum)
+                    wf.write(chunk)
+        except ValueError as e:
+            print(f"Can't unpack {args.input}: {e}")
+            sys.exit(1)
+
+    if checksum is not None and decoded_checksum != checksum:
+        print("Stream corruption detected!")
+        sys.exit(1)
+
+
+def unpack_range(args: argparse.Namespace) -> None:
+    with open(args.input, "rb") as rf:
+        encoded, _ = split_trailer(rf.read())
+
+    start, length = args.range
+    index = None if is_framed(encoded) else read_index(args.input, encoded)
+    dictionary = read_dictionary(args.dictionary)
+    with stage("decode"):
+        try:
+            decoded = decode_range(encoded, start, length, index, dictionary)
+        except ValueError as e:
+            print(f"Can't unpack {args.input}: {e}")
+            sys.exit(1)
+
+    with open(args.output, "wb") as wf:
+        wf.write(decoded)
+
+
+def info_file(args: argparse.Namespace) -> None:
+    with open(args.input, "rb") as rf:
+        data = rf.read()
+
+    sidecar = None if args.decode else read_sidecar(args.input, data)
+    data, checksum = split_trailer(data)
+    if checksum is not None:
+        print(f"{checksum:08x}\tchecksum")
+
+    with stage("info"):
+        if sidecar is not None:
+            print_sidecar(sidecar)
+        elif is_framed(data):
+            info_framed(data)
+        else:
+            info(data)
+
+
+def batch_output_path(input_path: str, mode: str, output_dir: str) -> str:
+    name = os.path.basename(input_path)
+    if mode == "pack":
+        name += ".bw"
+    elif name.endswith(".bw"):
+        name = name[: -len(".bw")]
+    else:
+        name += ".out"
+
+    return os.path.join(output_dir, name)
+
+
+def batch_paths(args: argparse.Namespace) -> List[Tuple[str, str]]:
+    # Manifest lines hold an input and optionally where its output goes, shell-quoted, with # starting a comment
+    paths = []
+    if args.manifest:
+        with open(args.manifest, "r") as rf:
+            for line in rf:
+                fields = shlex.split(line, comments=True)
+                if fields:
+                    output_path = fields[1] if len(fields) > 1 else None
+                    paths.append((fields[0], output_path))
+
+    for pattern in args.inputs:
+        # Patterns that match nothing are kept as paths, so they fail loudly
+        for input_path in sorted(glob.glob(pattern)) or [pattern]:
+            paths.append((input_path, None))
+
+    return [
+        (
+            input_path,
+            output_path or batch_output_path(input_path, args.mode, args.output_dir),
+        )
+        for input_path, output_path in paths
+    ]
+
+
+def batch_collisions(paths: List[Tuple[str, str]]) -> List[str]:
+    # Outputs named after the inputs' basenames clash when inputs from different directories share one, and an output
+    # mustn't overwrite an input either
+    claimed: Dict[str, str] = {}
+    for input_path, _ in paths:
+        claimed[os.path.abspath(input_path)] = input_path
+
+    collisions = []
+    for input_path, output_path in paths:
+        target = os.path.abspath(output_path)
+        if target in claimed:
+            collisions.append(
+                f"{input_path} -> {output_path} clashes with {claimed[target]}"
+            )
+        else:
+            claimed[target] = input_path
+
+    return collisions
+
+
+def batch_job(mode: str, job: argparse.Namespace) -> Dict[str, Any]:
+    # Runs in a worker, with the usual per-file output swallowed to keep the summary readable
+    start = time.perf_counter()
+    error = None
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            if mode == "pack":
+                pack_file(job)
+            else:
+                unpack_file(job)
+    except SystemExit:
+        lines = output.getvalue().splitlines()
+        error = lines[-1] if lines else "failed"
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    sizes = []
+    for path in (job.input, job.output):
+        try:
+            sizes.append(os.path.getsize(path))
+        except OSError:
+            sizes.append(0)
+
+    return {
+        "input": job.input,
+        "output": job.output,
+        "input bytes": sizes[0],
+        "output bytes": sizes[1],
+        "seconds": time.perf_counter() - start,
+        "error": error,
+    }
+
+
+def batch_file(args: argparse.Namespace) -> None:
+    start = time.perf_counter()
+    jobs = []
+    paths = batch_paths(args)
+    collisions = batch_collisions(paths)
+    if collisions:
+        for collision in collisions:
+            print(collision)
+
+        sys.exit(2)
+
+    for input_path, output_path in paths:
+        job = argparse.Namespace(
+            input=input_path,
+            output=output_path,
+            jobs=1,
+            range=None,
+            dictionary=args.dictionary,
+        )
+        if args.mode == "pack":
+            job.block_size = None
+            job.verify = args.verify
+            job.passes = args.passes
+            job.memory_limit = args.memory_limit
+            job.level = args.level
+            job.tune = args.tune
+            job.byte_literals = args.byte_literals
+            job.checkpoints = args.checkpoints
+            job.incremental = args.incremental
+            job.cache = args.cache
+            job.cache_size = args.cache_size
+
+        jobs.append(job)
+
+    # Largest first, so a big input picked up last doesn't leave the other workers idle at the end
+    def input_size(job: argparse.Namespace) -> int:
+        try:
+            return os.path.getsize(job.input)
+        except OSError:
+            return 0
+
+    jobs.sort(key=input_size, reverse=True)
+    os.makedirs(args.output_dir, exist_ok=True)
+    with ProcessPoolExecutor(args.jobs, initializer=new_models) as pool:
+        results = list(pool.map(batch_job, [args.mode] * len(jobs), jobs))
+
+    results.sort(key=operator.itemgetter("input"))
+    # Ratios are always packed size over unpacked size
+    packed, unpacked = "output bytes", "input bytes"
+    if args.mode == "unpack":
+        packed, unpacked = unpacked, packed
+
+    lines = [f"{'ratio':>8}  {'seconds':>8}  file"]
+    for result in results:
+        if result["error"] is not None:
+            status = f"{'failed':>8}  {result['seconds']:8.2f}"
+            lines.append(f"{status}  {result['input']}: {result['error']}")
+        else:
+            ratio = 100 * result[packed] / max(1, result[unpacked])
+            status = f"{ratio:7.2f}%  {result['seconds']:8.2f}"
+            lines.append(f"{status}  {result['input']} -> {result['output']}")
+
+    # Failed jobs may have left nothing behind, or an output from an earlier run, so they don't count towards the total
+    succeeded = [result for result in results if result["error"] is None]
+    packed_bytes = sum(result[packed] for result in succeeded)
+    unpacked_bytes = sum(result[unpacked] for result in succeeded)
+    total_ratio = 100 * packed_bytes / max(1, unpacked_bytes)
+    wall = time.perf_counter() - start
+    total = f"{len(succeeded)} files in all"
+    if len(succeeded) < len(results):
+        total += f", {len(results) - len(succeeded)} failed"
+
+    lines.append(f"{total_ratio:7.2f}%  {wall:8.2f}  {total}")
+
+    summary = "\n".join(lines)
+    print(summary)
+    if args.summary:
+        with open(args.summary, "w") as wf:
+            print(summary, file=wf)
+
+    if any(result["error"] is not None for result in results):
+        sys.exit(1)
+
+
+def dictionary_file(args: argparse.Namespace) -> None:
+    paths = []
+    for pattern in args.samples:
+        paths += sorted(glob.glob(pattern)) or [pattern]
+
+    if len(paths) < 2:
+        print("Give two or more samples, dictionaries are built from what they share")
+        sys.exit(2)
+
+    samples = []
+    for path in paths:
+        with open(path, "rb") as rf:
+            samples.append(rf.read())
+
+    if args.size > WINDOW_SIZE:
+        print(f"Only the last {WINDOW_SIZE} bytes of the dictionary can be reached")
+
+    with stage("dictionary"):
+        dictionary = build_dictionary(samples, args.size)
+
+    with open(args.output, "wb") as wf:
+        wf.write(dictionary)
+
+    print(len(samples), "samples", sep="\t")
+    print(sum(map(len, samples)), "bytes sampled", sep="\t")
+    print(len(dictionary), "bytes in dictionary", sep="\t")
+    print(f"{zlib.crc32(dictionary):08x}\tdictionary checksum")
+
+
+# A long-lived server keeps the interpreter, the modules and the model templates warm in a pool of workers, so each
+# pack, unpack or info only costs a connection. The CLI, weave.py for the least start-up cost, hands those commands to
+# the server whenever one is listening, and does the work itself otherwise. Each connection carries one JSON request
+# line, the arguments, working directory, the environment variables that change what a run does, and the version of
+# the source. The server answers with one JSON line saying whether it takes the job, and then another with what the
+# command printed and its exit status. The workers run whatever code the server started with, so once the source on
+# disk has changed, the server refuses the request, leaving the client to do the work itself, and shuts down rather
+# than fill the pack cache with the old coder's output.
+def serve_job(
+    argv: List[str], cwd: str, environment: Dict[str, str]
+) -> Tuple[int, str]:
+    # Runs in a worker, which only ever has one job at a time, so changing directory and environment is safe
+    global CACHE_DIR
+    output = io.StringIO()
+    status = 0
+    try:
+        os.chdir(cwd)
+        for name in weave.SERVER_ENVIRONMENT:
+            if name in environment:
+                os.environ[name] = environment[name]
+            else:
+                os.environ.pop(name, None)
+
+        CACHE_DIR = os.environ.get("BITWEAVER_CACHE", DEFAULT_CACHE_DIR)
+        args = make_parser().parse_args(argv)
+        with contextlib.redirect_stdout(output):
+            COMMANDS[args.command](args)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    except Exception:
+        output.write(traceback.format_exc())
+        status = 1
+
+    return status, output.getvalue()
+
+
+def served(argv: List[str]) -> bool:
+    # Whether a client's command is one the server runs, rather than one it sent over by mistake or couldn't rule out
+    try:
+        with contextlib.redirect_stderr(io.StringIO()):
+            args = make_parser().parse_args(argv)
+    except SystemExit:
+        return False  # The client reports the error itself
+
+    return (
+        args.command in weave.SERVED_COMMANDS
+        and args.server
+        and not (args.profile or args.cprofile)
+    )
+
+
+async def serve_forever(path: str, pool: ProcessPoolExecutor, version: str) -> None:
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    stale = asyncio.Event()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = json.loads(await reader.readline())
+            current = request.get("version") == version
+            accepted = current and served(request["argv"])
+            writer.write(json.dumps({"accepted": accepted}).encode() + b"\n")
+            await writer.drain()
+            if not current:
+                stale.set()
+
+            if not accepted:
+                return
+
+            status, output = await loop.run_in_executor(
+                pool,
+                serve_job,
+                request["argv"],
+                request["cwd"],
+                request.get("environment", {}),
+            )
+            response = {"status": status, "output": output}
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+        except (OSError, ValueError, KeyError):
+            pass  # The client falls back to working by itself
+        finally:
+            writer.close()
+
+    # Only the user gets to connect
+    umask = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(handle, path)
+    finally:
+        os.umask(umask)
+
+    async with server:
+        await stale.wait()
+
+    print("Source changed since the server started, shutting down")
+
+
+def serve(args: argparse.Namespace) -> None:
+    import asyncio
+
+    if not hasattr(socket, "AF_UNIX"):
+        print("Unix domain sockets aren't available here")
+        sys.exit(1)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(args.socket)
+        except OSError:
+            # Whatever's left at the path isn't listening any more
+            if os.path.lexists(args.socket):
+                if not weave.own_socket(args.socket):
+                    print(f"{args.socket} belongs to someone else")
+                    sys.exit(1)
+
+                os.remove(args.socket)
+        else:
+            print(f"Already serving on {args.socket}")
+            sys.exit(1)
+
+    # The workers are forked from this process, so they run the code it loaded a moment ago
+    version = weave.source_version()
+    print(f"Serving on {args.socket}")
+    with ProcessPoolExecutor(args.jobs, initializer=new_models) as pool:
+        try:
+            asyncio.run(serve_forever(args.socket, pool, version))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(args.socket)
+
+
+def tuning_grid(text: str) -> Dict[str, List[Any]]:
+    # JSON overriding entries of the default grid, so '{"layout": [[false, true, false]]}' keeps streams mini.asm can
+    # decode
+    try:
+        grid = dict(TUNING_GRID, **json.loads(text))
+    except (ValueError, TypeError) as e:
+        raise argparse.ArgumentTypeError(f"not a JSON object: {e}")
+
+    unknown = set(grid) - set(TUNING_GRID)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown parameters: {', '.join(unknown)}")
+
+    return grid
+
+
+def byte_count(text: str) -> int:
+    scale = 1
+    for suffix, multiplier in (("K", 2**10), ("M", 2**20), ("G", 2**30)):
+        if text.upper().endswith(suffix):
+            text, scale = text[:-1], multiplier
+
+    try:
+        count = int(text) * scale
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid byte count: {text!r}")
+
+    if count <= 0:
+        raise argparse.ArgumentTypeError("byte counts must be positive")
+
+    return count
+
+
+def memory_limit(text: str) -> int:
+    count = byte_count(text)
+    try:
+        segment_size(count)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+    return count
+
+
+def make_parser() -> argparse.ArgumentParser:
+    profile_parser = argparse.ArgumentParser(add_help=False)
+    profile_parser.add_argument(
+        "--profile", help="write per-stage timings and counters here as JSON"
+    )
+    profile_parser.add_argument(
+        "--cprofile", help="write cProfile statistics here, for pstats or snakeviz"
+    )
+    client_parser = argparse.ArgumentParser(add_help=False)
+    client_parser.add_argument(
+        "--socket",
+        default=weave.default_socket(),
+        help="where to find a running server (default: $BITWEAVER_SOCKET, or one in "
+        "$XDG_RUNTIME_DIR or the temporary directory)",
+    )
+    client_parser.add_argument(
+        "--no-server",
+        dest="server",
+        action="store_false",
+        help="do the work in this process even if a server is running",
+    )
+    dictionary_parser = argparse.ArgumentParser(add_help=False)
+    dictionary_parser.add_argument(
+        "--dictionary",
+        help="preset dictionary to start the window with, as written by the "
+        "dictionary command; unpacking needs the same one, and mini.asm can't",
+    )
+    pack_options = argparse.ArgumentParser(add_help=False, parents=[dictionary_parser])
+    pack_options.add_argument(
+        "--verify",
+        choices=("full", "sampled", "async"),
+        default="full",
+        help="decode everything before writing (full), only the start, leaving a "
+        "checksum for unpack (sampled), or everything while writing (async)",
+    )
+    pack_options.add_argument(
+        "--level",
+        type=int,
+        choices=sorted(LEVELS),
+        default=DEFAULT_LEVEL,
+        help="1 and 2 parse greedily, 3 to 5 lazily, 6 to 9 optimally, following more "
+        f"match candidates the higher the level (default: {DEFAULT_LEVEL})",
+    )
+    pack_options.add_argument(
+        "--tune",
+        action="store_const",
+        const=TUNING_GRID,
+        help="code under every combination of chain layout, window size and minimum "
+        "match length in parallel, keeping the smallest",
+    )
+    pack_options.add_argument(
+        "--tune-grid",
+        dest="tune",
+        type=tuning_grid,
+        help="tune over this JSON object instead, overriding parts of the default grid",
+    )
+    pack_options.add_argument(
+        "--byte-literals",
+        action="store_true",
+        help="code literals a byte at a time through a multi-symbol model, which is "
+        "faster but can't be decoded by mini.asm",
+    )
+    pack_options.add_argument(
+        "--passes",
+        type=int,
+        default=1,
+        help="re-parse this many times in all, pricing codes by the models",
+    )
+    pack_options.add_argument(
+        "--memory-limit",
+        type=memory_limit,
+        help="parse a segment at a time to keep memory use under this many bytes "
+        "(K, M and G suffixes allowed), memory-mapping the input",
+    )
+    pack_options.add_argument(
+        "--incremental",
+        action="store_true",
+        help=f"keep the parse in a {PARSE_SUFFIX} side-car and only re-parse around "
+        "what changed in the input since",
+    )
+    pack_options.add_argument(
+        "--checkpoints",
+        type=int,
+        help=f"write a {INDEX_SUFFIX} side-car with a decoder checkpoint about every "
+        "this many output bytes, so unpack --range can start part way through",
+    )
+    pack_options.add_argument(
+        "--cache",
+        default=CACHE_DIR,
+        help=f"directory of previously packed streams (default: {CACHE_DIR})",
+    )
+    pack_options.add_argument(
+        "--no-cache", dest="cache", action="store_const", const=None
+    )
+    pack_options.add_argument(
+        "--cache-size", type=int, default=CACHE_SIZE, help="cache size limit in bytes"
+    )
+    parser = argparse.ArgumentParser(prog="bitweaver.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+    pack_parser = commands.add_parser(
+        "pack", parents=[profile_parser, client_parser, pack_options]
+    )
+    pack_parser.add_argument("input")
+    pack_parser.add_argument("output")
+    pack_parser.add_argument(
+        "--block-size",
+        type=int,
+        help="write the framed container, coding blocks of this size in parallel",
+    )
+    pack_parser.add_argument("--jobs", type=int, help="worker processes to use")
+    unpack_parser = commands.add_parser(
+        "unpack", parents=[profile_parser, client_parser, dictionary_parser]
+    )
+    unpack_parser.add_argument("input")
+    unpack_parser.add_argument("output")
+    unpack_parser.add_argument("--jobs", type=int, help="worker processes to use")
+    unpack_parser.add_argument(
+        "--range",
+        type=int,
+        nargs=2,
+        metavar=("START", "LENGTH"),
+        help=f"only write these output bytes, starting from the nearest checkpoint in "
+        f"the {INDEX_SUFFIX} side-car if it's up to date",
+    )
+    info_parser = commands.add_parser("info", parents=[profile_parser, client_parser])
+    info_parser.add_argument("input")
+    info_parser.add_argument(
+        "--decode",
+        action="store_true",
+        help=f"decode the stream even if its {SIDECAR_SUFFIX} side-car is up to date",
+    )
+    # The mode is a subcommand, so options can come after it, among the inputs
+    batch_options = argparse.ArgumentParser(
+        add_help=False, parents=[profile_parser, pack_options]
+    )
+    batch_options.add_argument("inputs", nargs="*", help="input files or glob patterns")
+    batch_options.add_argument(
+        "--manifest", help="file listing an input and optionally its output per line"
+    )
+    batch_options.add_argument(
+        "--output-dir", default=".", help="where outputs go unless the manifest says"
+    )
+    batch_options.add_argument("--jobs", type=int, help="worker processes to use")
+    batch_options.add_argument("--summary", help="also write the summary table here")
+    batch_parser = commands.add_parser("batch")
+    batch_modes = batch_parser.add_subparsers(dest="mode", required=True)
+    for mode in ("pack", "unpack"):
+        batch_modes.add_parser(mode, parents=[batch_options])
+    dictionary_command = commands.add_parser("dictionary", parents=[profile_parser])
+    dictionary_command.add_argument("output", help="dictionary file to write")
+    dictionary_command.add_argument(
+        "samples", nargs="+", help="sample files or glob patterns to build it from"
+    )
+    dictionary_command.add_argument(
+        "--size",
+        type=byte_count,
+        default=DICTIONARY_SIZE,
+        help=f"largest dictionary to build (K and M suffixes allowed), though only the "
+        f"last {WINDOW_SIZE} bytes can be reached, so anything more is wasted "
+        f"(default: {DICTIONARY_SIZE})",
+    )
+    serve_parser = commands.add_parser("serve")
+    serve_parser.add_argument(
+        "--socket",
+        default=weave.default_socket(),
+        help="Unix domain socket to listen on (default: $BITWEAVER_SOCKET, or one in "
+        "$XDG_RUNTIME_DIR or the temporary directory)",
+    )
+    serve_parser.add_argument("--jobs", type=int, help="worker processes to use")
+    return parser
+
+
+COMMANDS: Dict[str, Callable[[argparse.Namespace], None]] = {
+    "pack": pack_file,
+    "unpack": unpack_file,
+    "info": info_file,
+    "batch": batch_file,
+    "dictionary": dictionary_file,
+}
+
+
+def main(argv: Optional[List[str]] = None, server: bool = True) -> None:
+    # weave.py has already tried the server by the time it gets here, and says so with server=False
+    argv = sys.argv[1:] if argv is None else argv
+    args = make_parser().parse_args(argv)
+    if args.command == "serve":
+        serve(args)
+        sys.exit(0)
+
+    # Profiles are of this process, so those runs stay here
+    if (
+        server
+        and getattr(args, "server", False)
+        and not (args.profile or args.cprofile)
+    ):
+        status = weave.run_on_server(argv, args.socket)
+        if status is not None:
+            sys.exit(status)
+
+    profile = Profile() if args.profile else None
+    profiler = None
+    if args.cprofile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+
+    try:
+        with contextlib.ExitStack() as stack:
+            if profile is not None:
+                stack.enter_context(profiling(profile))
+
+            if profiler is not None:
+                stack.enter_context(profiler)
+
+            COMMANDS[args.command](args)
+    finally:
+        # Still written when verification fails, which is when they're wanted most
+        if profile is not None:
+            with open(args.profile, "w") as wf:
+                json.dump(profile.as_dict(), wf, indent=4)
+
+        if profiler is not None:
+            profiler.dump_stats(args.cprofile)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,129 @@
+import os
 import sys
+import argparse
+
+# Each line is assembled from preformatted pieces and the whole file is written at once. Wider directives and incbin
+# leave NASM fewer tokens to get through.
+ESCAPES = ["\\x{:02x}".format(byte) for byte in range(256)]
+DB_LINE_BYTES = 16
+WIDTHS = {"dd": 4, "dq": 8}
+WORDS_PER_LINE = 4
+
+# The stream formats mini.asm can't decode, and the checksum trailer, as bitweaver.py writes them. Importing
+# bitweaver.py takes several times longer than the rest of a run, so the magics are repeated here.
+FRAME_MAGIC = b"BWFR"
+TUNED_MAGIC = b"BWTU"
+DICTIONARY_MAGIC = b"BWDC"
+TRAILER_MAGIC = b"BWCK"
+TRAILER_SIZE = 4 + len(TRAILER_MAGIC)
+
+
+def split_trailer(data: bytes) -> bytes:
+    if len(data) >= TRAILER_SIZE and data[-len(TRAILER_MAGIC) :] == TRAILER_MAGIC:
+        return data[:-TRAILER_SIZE]
+
+    return data
+
+
+def db_lines(data: bytes) -> str:
+    lines = []
+    for i in range(0, len(data), DB_LINE_BYTES):
+        chunk = data[i : i + DB_LINE_BYTES]
+        lines.append("db `" + "".join(map(ESCAPES.__getitem__, chunk)) + "`\n")
+
+    return "".join(lines)
+
+
+def word_lines(data: bytes, directive: str) -> str:
+    # Little-endian words, so the bytes land in memory in the same order, with any leftovers as a db line
+    width = WIDTHS[directive]
+    line_bytes = width * WORDS_PER_LINE
+    digits = "0x{:0" + str(2 * width) + "x}"
+    whole = len(data) - len(data) % width
+    lines = []
+    for i in range(0, whole, line_bytes):
+        words = [
+            digits.format(int.from_bytes(data[j : j + width], "little"))
+            for j in range(i, min(i + line_bytes, whole), width)
+        ]
+
+        lines.append(f"{directive} {', '.join(words)}\n")
+
+    return "".join(lines) + db_lines(data[whole:])
+
+
+def up_to_date(source: str, destination: str, header: str, directive: str) -> bool:
+    # The header records how the output was generated, so switching directives regenerates it too. incbin output is
+    # only current if the binary the include points at is as well.
+    outputs = [destination]
+    if directive == "incbin":
+        outputs.append(binary_path(destination))
+
+    try:
+        if min(map(os.path.getmtime, outputs)) < max(
+            os.path.getmtime(source), os.path.getmtime(__file__)
+        ):
+            return False
+
+        with open(destination, "r") as file:
+            return file.readline() == header
+    except OSError:
+        return False
+
+
+def binary_path(destination: str) -> str:
+    # Appended rather than swapped in for the extension, so kernel.inc can't overwrite kernel.bin
+    return destination + ".bin"
+
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python huffman.py <filename> <destination>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(prog="inc.py")
+    parser.add_argument("filename", help="packed stream, as written by bitweaver.py")
+    parser.add_argument("destination", help="NASM include file to write")
+    parser.add_argument(
+        "--directive",
+        choices=("db", "dd", "dq", "incbin"),
+        default="db",
+        help="how to emit the stream; incbin writes it next to the destination with .bin appended",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="regenerate even if up to date"
+    )
+
+    args = parser.parse_args()
 
-    filename = sys.argv[1]
-    with open(filename, "rb") as file:
-        data = file.read()
+    header = f"; Generated by inc.py from {args.filename} ({args.directive})\n"
+    if not args.force and up_to_date(
+        args.filename, args.destination, header, args.directive
+    ):
+        sys.exit(0)
 
-    with open(sys.argv[2], "w") as file:
-        i = 0
-        for byte in data:
-            if i % 16 == 0:
-                print("db `", end="", file=file)
+    with open(args.filename, "rb") as file:
+        data = split_trailer(file.read())
+
+    if data[:4] in (FRAME_MAGIC, TUNED_MAGIC, DICTIONARY_MAGIC):
+        print(
+            "mini.asm only decodes single streams with the default chain layout and no "
+            "dictionary"
+        )
+        sys.exit(1)
 
-            print("\\x{:02x}".format(byte), end="", file=file)
+    if args.directive == "incbin":
+        if os.path.abspath(binary_path(args.destination)) == os.path.abspath(
+            args.filename
+        ):
+            print(f"{binary_path(args.destination)} would overwrite the packed stream")
+            sys.exit(1)
 
-            if i % 16 == 15:
-                print("`", file=file)
+        with open(binary_path(args.destination), "wb") as file:
+            file.write(data)
 
-            i += 1
+        # NASM resolves the path from where it runs, like %include
+        body = f'incbin "{os.path.basename(binary_path(args.destination))}"\n'
+    elif args.directive == "db":
+        body = db_lines(data)
+    else:
+        body = word_lines(data, args.directive)
 
-        if i % 16 != 0:
-            print("`", file=file)
+    with open(args.destination, "w") as file:
+        file.write(header + body)
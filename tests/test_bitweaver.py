@@ -0,0 +1,340 @@
+import os
+import sys
+import zlib
+import random
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bitweaver
+
+WORDS = [
+    b"mov",
+    b"rax",
+    b"rbx",
+    b"push",
+    b"pop",
+    b"call",
+    b"ret",
+    b"0x1f",
+    b", ",
+    b"\n",
+]
+
+
+def sample(size: int, seed: int = 0) -> bytes:
+    # Assembly-flavoured text with plenty of matches, and a few random bytes so literals get coded too
+    rng = random.Random(seed)
+    data = bytearray()
+    while len(data) < size:
+        data += rng.choice(WORDS) if rng.random() < 0.9 else bytes([rng.randrange(256)])
+
+    return bytes(data[:size])
+
+
+def pack(data: bytes, **options) -> bytes:
+    return bitweaver.encode(data, len(data), verbose=False, **options)
+
+
+def edit(data: bytes, rng: random.Random) -> bytes:
+    # Replaces, inserts or deletes a few bytes somewhere
+    at = rng.randrange(len(data))
+    removed = rng.choice([0, 1, 5])
+    inserted = bytes(rng.randrange(256) for _ in range(rng.choice([0, 1, 7])))
+    return data[:at] + inserted + data[at + removed :]
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_incremental_matches_full_pack(seed):
+    rng = random.Random(seed)
+    data = sample(6000, seed)
+    incremental = {}
+    pack(data, incremental=incremental)
+    for _ in range(3):
+        data = edit(data, rng)
+        assert pack(data, incremental=incremental) == pack(data)
+
+
+def test_incremental_edits_at_the_ends():
+    data = sample(6000)
+    incremental = {}
+    pack(data, incremental=incremental)
+    for edited in (b"x" + data, data[1:], data + b"yz", data[:-3], data[:100]):
+        assert pack(edited, incremental=incremental) == pack(edited)
+
+
+def test_incremental_reparses_less_after_small_edit():
+    data = sample(6000)
+    incremental = {}
+    pack(data, incremental=incremental)
+    edited = data[:5000] + b"!" + data[5001:]
+    pack(edited, incremental=incremental)
+    assert incremental["reparsed"] < len(edited) // 2
+
+
+def test_incremental_starts_over_when_settings_change():
+    data = sample(6000)
+    incremental = {}
+    pack(data, incremental=incremental, level=8)
+    assert pack(data, incremental=incremental) == pack(data)
+    assert incremental["reparsed"] == len(data)
+
+
+def test_incremental_with_dictionary():
+    dictionary = sample(2000, 1)
+    data = sample(6000, 2)
+    incremental = {}
+    pack(data, incremental=incremental, dictionary=dictionary)
+    edited = data[:3000] + b"ret\n" + data[3000:]
+    assert pack(edited, incremental=incremental, dictionary=dictionary) == pack(
+        edited, dictionary=dictionary
+    )
+
+
+RANGES = [
+    (0, 10),
+    (0, 20000),
+    (2047, 2),
+    (2048, 3000),
+    (9000, 1),
+    (19990, 100),
+    (5000, 0),
+]
+
+
+@pytest.fixture(scope="module")
+def indexed():
+    data = sample(20000, 3)
+    encoded = pack(data)
+    return (
+        data,
+        encoded,
+        bitweaver.CheckpointIndex(bitweaver.build_index(encoded, 2048)),
+    )
+
+
+@pytest.mark.parametrize("start, length", RANGES)
+def test_decode_range_without_index(indexed, start, length):
+    data, encoded, _ = indexed
+    assert (
+        bitweaver.decode_range(encoded, start, length) == data[start : start + length]
+    )
+
+
+@pytest.mark.parametrize("start, length", RANGES)
+def test_decode_range_from_checkpoints(indexed, start, length):
+    data, encoded, index = indexed
+    assert len(index.positions) > 1
+    decoded = bitweaver.decode_range(encoded, start, length, index)
+    assert decoded == data[start : start + length]
+
+
+def test_decode_range_with_layout_and_dictionary():
+    dictionary = sample(3000, 4)
+    data = sample(12000, 5)
+    encoded = pack(data, layout=bitweaver.BYTE_LITERALS_LAYOUT, dictionary=dictionary)
+    index = bitweaver.CheckpointIndex(bitweaver.build_index(encoded, 1024, dictionary))
+    for start, length in RANGES:
+        expected = data[start : start + length]
+        assert (
+            bitweaver.decode_range(encoded, start, length, None, dictionary) == expected
+        )
+        assert (
+            bitweaver.decode_range(encoded, start, length, index, dictionary)
+            == expected
+        )
+
+
+def test_decode_range_framed():
+    data = sample(20000, 6)
+    encoded = bitweaver.encode_framed(
+        data, len(data), block_size=4096, jobs=1, verbose=False
+    )
+    for start, length in RANGES:
+        assert (
+            bitweaver.decode_range(encoded, start, length)
+            == data[start : start + length]
+        )
+
+
+def compress(data: bytes, chunk: int, **options) -> bytes:
+    compressor = bitweaver.Compressor(**options)
+    pieces = [
+        compressor.compress(data[i : i + chunk]) for i in range(0, len(data), chunk)
+    ]
+    return b"".join(pieces) + compressor.flush()
+
+
+def decompress(encoded: bytes, chunk: int, max_length: int = 0, **options) -> bytes:
+    decompressor = bitweaver.Decompressor(**options)
+    pieces = []
+    for i in range(0, len(encoded), chunk):
+        pieces.append(decompressor.decompress(encoded[i : i + chunk], max_length))
+        while decompressor.unconsumed_tail:
+            tail = decompressor.unconsumed_tail
+            pieces.append(decompressor.decompress(tail, max_length))
+
+    pieces.append(decompressor.flush())
+    assert decompressor.eof
+    return b"".join(pieces)
+
+
+@pytest.mark.parametrize("chunk", [1, 777, 50000])
+def test_compressor_matches_pack_with_whole_lookahead(chunk):
+    data = sample(8000, 7)
+    assert compress(data, chunk, size=len(data), lookahead=len(data)) == pack(data)
+
+
+@pytest.mark.parametrize("size_known", [True, False])
+def test_compressor_round_trip(size_known):
+    data = sample(12000, 8)
+    size = len(data) if size_known else None
+    encoded = compress(data, 1000, size=size, lookahead=4096)
+    assert bitweaver.decode(encoded) == data
+
+
+def test_compressor_checks_size():
+    compressor = bitweaver.Compressor(size=10)
+    with pytest.raises(ValueError):
+        compressor.compress(bytes(11))
+
+    compressor = bitweaver.Compressor(size=10)
+    compressor.compress(bytes(5))
+    with pytest.raises(ValueError):
+        compressor.flush()
+
+
+@pytest.mark.parametrize(
+    "chunk, max_length", [(1, 0), (100, 0), (100000, 0), (64, 1), (5000, 300)]
+)
+def test_decompressor_round_trip(chunk, max_length):
+    data = sample(20000, 9)
+    assert decompress(pack(data), chunk, max_length) == data
+
+
+def test_compressor_and_decompressor_with_layout_and_dictionary():
+    dictionary = sample(3000, 10)
+    data = sample(15000, 11)
+    options = dict(layout=bitweaver.BYTE_LITERALS_LAYOUT, dictionary=dictionary)
+    encoded = compress(data, 999, size=len(data), lookahead=4096, **options)
+    assert bitweaver.decode(encoded, dictionary) == data
+    assert decompress(encoded, 333, dictionary=dictionary) == data
+
+
+def test_decoder_reads_input_that_arrives_after_running_dry():
+    queue = bitweaver.InputQueue()
+    decoder = bitweaver.ac.Decoder(queue)
+    assert decoder.next_bitgroup() == 0
+    queue.queued += b"\x01\x02\x03"
+    assert [decoder.next_bitgroup() for _ in range(3)] == [2, 3, 0]
+    queue.queued += b"\x04\x05"
+    assert decoder.next_bitgroup() == 5
+
+
+def test_decoders_check_trailers():
+    for seed in range(20):
+        data = sample(3000 + 37 * seed, 20 + seed)
+        encoded = bitweaver.add_trailer(pack(data), data)
+        assert bitweaver.decode(encoded) == data
+        assert b"".join(bitweaver.iter_decode(encoded, 1000)) == data
+        assert decompress(encoded, 500) == data
+        assert bitweaver.decode_range(encoded, 100, 200) == data[100:300]
+
+
+def test_framed_decode_checks_trailer():
+    data = sample(10000, 12)
+    framed = bitweaver.encode_framed(
+        data, len(data), block_size=4096, jobs=1, verbose=False
+    )
+    assert bitweaver.decode_framed(bitweaver.add_trailer(framed, data), 1) == data
+    with pytest.raises(ValueError):
+        bitweaver.decode_framed(bitweaver.add_trailer(framed, data[1:]), 1)
+
+
+def test_mismatched_trailer_raises():
+    data = sample(5000, 13)
+    encoded = bitweaver.add_trailer(pack(data), data[:-1] + b"?")
+    with pytest.raises(ValueError):
+        bitweaver.decode(encoded)
+
+    with pytest.raises(ValueError):
+        b"".join(bitweaver.iter_decode(encoded, 1000))
+
+    with pytest.raises(ValueError):
+        decompress(encoded, 500)
+
+
+def pinned_inputs():
+    rng = random.Random(1)
+    yield "text", sample(5000, 30)
+    yield "zeros", bytes(3000)
+    yield "runs", b"".join(
+        bytes([rng.randrange(4)]) * rng.randrange(1, 300) for _ in range(40)
+    )
+    yield "noise", bytes(rng.randrange(256) for _ in range(1500))
+    yield "repeats", (sample(700, 31) + bytes(200)) * 6
+
+
+# Checksums of what the original coder, with its plain optimal parse, packs these inputs to. The default stream format
+# is what mini.asm decodes, so it has to stay byte for byte the same.
+PINNED = {
+    "text": 0xC08390C4,
+    "zeros": 0x7070AC53,
+    "runs": 0x7463E13F,
+    "noise": 0x4D649ECD,
+    "repeats": 0x14D9FC08,
+}
+
+
+@pytest.mark.parametrize("name, data", list(pinned_inputs()))
+def test_default_pack_matches_original_coder(name, data):
+    assert zlib.crc32(pack(data)) == PINNED[name]
+
+
+def test_costs_cheapest_matches_a_scan():
+    rng = random.Random(14)
+    size = 3 * bitweaver.COST_BLOCK**2
+    costs = bitweaver.Costs(size)
+    for i in range(size - 1, -1, -1):
+        costs.set(i, rng.randrange(20))
+
+    values = list(costs.values)
+    for _ in range(500):
+        start = rng.randrange(size)
+        end = rng.randrange(start, min(size, start + bitweaver.MAX_MATCH))
+        cost = min(values[start : end + 1])
+        last = max(j for j in range(start, end + 1) if values[j] == cost)
+        assert costs.cheapest(start, end) == (cost, last)
+
+
+@pytest.mark.parametrize("layout", [(False, True, False), (False, False, False)])
+def test_cost_model_prices_offsets_as_coded(layout):
+    # Walks each offset's code through the trained model's contexts, the way the coder spends bits on it
+    data = sample(8000, 15)
+    memo = bitweaver.parse(data, bitweaver.MatchFinder(data))
+    _, model, _ = bitweaver.code_parse(data, len(data), memo, layout)
+    costs = bitweaver.CostModel(model)
+    bit_costs = model.bit_costs()
+    root = model.tags.index("root")
+    for offset in (1, 0x7F, 0x80, 0x1234, 0x4001, 0x7FFF):
+        node, cost = model.children[2 * root + 1], 0.0
+        for byte in bitweaver.encode_15bit(offset):
+            for shift in range(7, -1, -1):
+                bit = byte >> shift & 1
+                cost += bit_costs[2 * node + bit]
+                node = model.children[2 * node + bit]
+
+        assert costs.offset[offset] == pytest.approx(cost)
+
+
+@pytest.mark.parametrize("level", sorted(bitweaver.LEVELS))
+def test_level_round_trip(level):
+    data = sample(6000, 16) + bytes(500) + sample(2000, 16)
+    assert bitweaver.decode(pack(data, level=level)) == data
+
+
+def test_levels_get_deeper():
+    limits = [bitweaver.LEVELS[level][1] for level in sorted(bitweaver.LEVELS)]
+    depths = [float("inf") if limit is None else limit for limit in limits]
+    assert depths == sorted(depths)
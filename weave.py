@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import os
+import sys
+import json
+import stat
+import socket
+import getpass
+import hashlib
+import tempfile
+
+# The command line, for when a server (python bitweaver.py serve) is likely to be running. Only modules that import
+# quickly get loaded before handing the command over, so a small job costs little more than the connection.
+# bitweaver.py, with asyncio, the process pool and the coder, only gets imported, from its cached bytecode, when there's
+# no server to take the command. python bitweaver.py works as before, just with that start-up cost on every run.
+SERVED_COMMANDS = ("pack", "unpack", "info")
+# Variables that change what a run does, which the server takes from the client
+SERVER_ENVIRONMENT = ("BITWEAVER_CACHE",)
+# Seconds to wait for a server to take a job, after which the client does the work itself
+SERVER_TIMEOUT = 5.0
+# A server runs the code it started with, so any change to these, not just to the coder, leaves it out of date
+SOURCES = ("ac.py", "bitweaver.py", "weave.py")
+
+
+def source_version() -> str:
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in SOURCES:
+        with open(os.path.join(directory, name), "rb") as rf:
+            digest.update(rf.read())
+
+    return digest.hexdigest()
+
+
+def default_socket() -> str:
+    # The runtime directory is private to the user, while the temporary directory isn't, so sockets found there only
+    # get used if they're the user's own
+    if "BITWEAVER_SOCKET" in os.environ:
+        return os.environ["BITWEAVER_SOCKET"]
+
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "bitweaver.sock")
+
+    name = f"bitweaver-{getpass.getuser()}.sock"
+    return os.path.join(tempfile.gettempdir(), name)
+
+
+def own_socket(path: str) -> bool:
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+
+def server_socket(argv: list[str]) -> str | None:
+    # Where to send the command, if anywhere. Only the options that decide that get picked out here, without argparse.
+    # The server parses the rest, and turns down anything it wouldn't run, abbreviated options included.
+    if not argv or argv[0] not in SERVED_COMMANDS or "--no-server" in argv:
+        return None
+
+    path = default_socket()
+    for i, arg in enumerate(argv):
+        if arg.startswith(("--profile", "--cprofile")):
+            return None  # Profiles are of this process
+        elif arg == "--socket" and i + 1 < len(argv):
+            path = argv[i + 1]
+        elif arg.startswith("--socket="):
+            path = arg[len("--socket=") :]
+
+    return path
+
+
+def run_on_server(argv: list[str], path: str) -> int | None:
+    # None if there's no server to run on, or it won't take the job
+    if not hasattr(socket, "AF_UNIX") or not own_socket(path):
+        return None
+
+    request = {
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "environment": {
+            name: os.environ[name] for name in SERVER_ENVIRONMENT if name in os.environ
+        },
+        "version": source_version(),
+    }
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(SERVER_TIMEOUT)
+            client.connect(path)
+            client.sendall(json.dumps(request).encode() + b"\n")
+            with client.makefile("rb") as rf:
+                if not json.loads(rf.readline()).get("accepted"):
+                    return None
+
+                # Jobs take as long as they take once they've started
+                client.settimeout(None)
+                response = json.loads(rf.readline())
+    except (OSError, ValueError):
+        return None
+
+    print(response["output"], end="")
+    return response["status"]
+
+
+def main() -> None:
+    argv = sys.argv[1:]
+    path = server_socket(argv)
+    if path is not None:
+        status = run_on_server(argv, path)
+        if status is not None:
+            sys.exit(status)
+
+    import bitweaver
+
+    bitweaver.main(argv, server=False)
+
+
+if __name__ == "__main__":
+    main()